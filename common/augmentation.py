@@ -0,0 +1,125 @@
+import torch
+import torch.nn.functional as F
+from common import data
+
+
+class BatchHemisphericFlip(object):
+    """Flip a random subset of the collated torch batch along X-axis."""
+    def __init__(self, probability=0.5):
+        self._probability = probability
+
+    def __call__(self, batch):
+        result = dict(batch)
+        flip = None
+        for key in [data.KEY_IMAGES, data.KEY_LABELS]:
+            volumes = batch[key]
+            if not torch.is_tensor(volumes):
+                continue
+            if flip is None:
+                flip = (torch.rand(volumes.size()[0]) < self._probability).view(-1, 1, 1, 1, 1).to(volumes.device)
+            result[key] = torch.where(flip, volumes.flip(data.DIM_HORIZONTAL_TORCH3D_5), volumes)
+        return result
+
+
+class BatchElasticDeform(object):
+    """Elastic deformation of the collated torch batch BxCxDxHxW with grid_sample.
+    As ElasticDeform in fast mode, smooth displacements are drawn on a coarse
+    control grid with grid_spacing voxels and upsampled, one field per sample
+    applied to all its label (and optionally image) channels.
+    """
+    def __init__(self, alpha=100, sigma=4, apply_to_images=False, grid_spacing=4):
+        self._alpha = alpha
+        self._sigma = sigma
+        self._apply_to_images = apply_to_images
+        self._grid_spacing = grid_spacing
+
+    def _smooth(self, noise, sigma):
+        radius = int(4 * sigma + 0.5)
+        kernel = torch.exp(-0.5 * (torch.arange(-radius, radius + 1, dtype=noise.dtype) / sigma) ** 2)
+        kernel = (kernel / kernel.sum()).to(noise.device)
+        channels = noise.size()[1]
+        for dim in range(3):
+            shape = [1, 1, 1]
+            shape[dim] = len(kernel)
+            padding = [0, 0, 0]
+            padding[dim] = radius
+            weight = kernel.view([1, 1] + shape).repeat(channels, 1, 1, 1, 1)
+            noise = F.conv3d(noise, weight, padding=padding, groups=channels)  # zero padding as mode="constant"
+        return noise
+
+    def displacement(self, batch_size, size, device):
+        """Smooth random displacements Bx3xDxHxW in voxels, ordered as x, y, z."""
+        coarse_size = [int(-(-s // self._grid_spacing)) + 1 for s in size]
+        coarse_sigma = self._sigma / self._grid_spacing
+        gain = data.gaussian_noise_gain(self._sigma) / data.gaussian_noise_gain(coarse_sigma)
+
+        noise = torch.rand([batch_size, 3] + coarse_size, device=device) * 2 - 1
+        coarse = self._smooth(noise, coarse_sigma)
+        scale = torch.tensor([1, 1, data.ElasticDeform.Z_SCALE], device=device).view(1, 3, 1, 1, 1)
+        coarse = coarse * (self._alpha * gain) * scale
+        return F.interpolate(coarse, size=list(size), mode='trilinear', align_corners=True)
+
+    def _sampling_grid(self, batch_size, size, device):
+        depth, height, width = size
+        displacement = self.displacement(batch_size, size, device)
+        grid_x = torch.arange(width, dtype=torch.float32, device=device).view(1, 1, 1, -1)
+        grid_y = torch.arange(height, dtype=torch.float32, device=device).view(1, 1, -1, 1)
+        grid_z = torch.arange(depth, dtype=torch.float32, device=device).view(1, -1, 1, 1)
+        positions = [grid_x + displacement[:, 0], grid_y + displacement[:, 1], grid_z + displacement[:, 2]]
+        normalized = [2 * p / max(n - 1, 1) - 1 for p, n in zip(positions, [width, height, depth])]
+        return torch.stack(normalized, dim=-1)
+
+    def _warp(self, volumes, grid):
+        if not volumes.is_floating_point():
+            volumes = volumes.float()
+        return F.grid_sample(volumes, grid.to(volumes.dtype), mode='bilinear', padding_mode='zeros',
+                             align_corners=True)
+
+    def __call__(self, batch):
+        result = dict(batch)
+        labels = batch[data.KEY_LABELS]
+        grid = self._sampling_grid(labels.size()[0], list(labels.size()[2:]), labels.device)
+        result[data.KEY_LABELS] = self._warp(labels, grid)
+        if self._apply_to_images and torch.is_tensor(batch[data.KEY_IMAGES]):
+            assert batch[data.KEY_IMAGES].size()[2:] == labels.size()[2:], \
+                'Images and labels must be of same size to be deformed.'
+            result[data.KEY_IMAGES] = self._warp(batch[data.KEY_IMAGES], grid)
+        return result
+
+
+class BatchRandomPatch(object):
+    """Random patches of certain size cropped from the collated torch batch,
+    with a separate origin per sample but a single gather for the batch.
+    """
+    def __init__(self, w, h, d, pad_x, pad_y, pad_z):
+        self._padx = pad_x
+        self._pady = pad_y
+        self._padz = pad_z
+        self._w = w
+        self._h = h
+        self._d = d
+
+    def _crop(self, volumes, origins, size):
+        batch_size = volumes.size()[0]
+        device = volumes.device
+        index_b = torch.arange(batch_size, device=device).view(-1, 1, 1, 1)
+        index_z = (origins[:, 2].view(-1, 1) + torch.arange(size[2], device=device)).view(batch_size, -1, 1, 1)
+        index_y = (origins[:, 1].view(-1, 1) + torch.arange(size[1], device=device)).view(batch_size, 1, -1, 1)
+        index_x = (origins[:, 0].view(-1, 1) + torch.arange(size[0], device=device)).view(batch_size, 1, 1, -1)
+        patches = volumes.permute(0, 2, 3, 4, 1)[index_b, index_z, index_y, index_x]  # BxDxHxWxC
+        return patches.permute(0, 4, 1, 2, 3)
+
+    def __call__(self, batch):
+        images = batch[data.KEY_IMAGES]
+        batch_size, _, sz, sy, sx = images.size()
+        limits = torch.tensor([sx - self._w + 1, sy - self._h + 1, sz - self._d + 1])
+        origins = (torch.rand(batch_size, 3) * limits.float()).long().to(images.device)
+
+        result = dict(batch)
+        result[data.KEY_IMAGES] = self._crop(images, origins, (self._w, self._h, self._d))
+        if torch.is_tensor(batch[data.KEY_LABELS]):
+            result[data.KEY_LABELS] = self._crop(batch[data.KEY_LABELS], origins,
+                                                 (self._w - 2 * self._padx,
+                                                  self._h - 2 * self._pady,
+                                                  self._d - 2 * self._padz))
+        return result
@@ -0,0 +1,159 @@
+import os
+import copy
+import queue
+import shutil
+import threading
+import torch
+
+
+def cpu_state(state):
+    """Copies all tensors of a (nested) state, e.g. an optimizer state_dict, into new CPU tensors."""
+    if torch.is_tensor(state):
+        return state.cpu() if state.is_cuda else state.clone()
+    if isinstance(state, dict):
+        return type(state)((key, cpu_state(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(cpu_state(value) for value in state)
+    return copy.deepcopy(state)
+
+
+def cpu_module(module):
+    """
+    Copies a module to the CPU without moving (or duplicating on the GPU) the live module:
+    parameters and buffers of its state_dict are copied into new CPU tensors, and only the
+    structure of the module is deep-copied around them.
+    """
+    memo = {}
+    for tensor in module.state_dict(keep_vars=True).values():
+        if id(tensor) in memo:
+            continue
+        if isinstance(tensor, torch.nn.Parameter):
+            memo[id(tensor)] = torch.nn.Parameter(cpu_state(tensor.data), requires_grad=tensor.requires_grad)
+        else:
+            memo[id(tensor)] = cpu_state(tensor)
+    return copy.deepcopy(module, memo)
+
+
+def save_atomic(obj, filename):
+    """Saves with torch.save to a temporary file and renames it, so that an
+    interrupted write never leaves a partially written checkpoint behind.
+    """
+    tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+
+def write_atomic(text, filename):
+    """Writes a text file via a temporary file and rename, see save_atomic."""
+    tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+
+def link_atomic(filename, alias):
+    """Makes alias another name of the (written) file, or a copy where hard links are not supported."""
+    tmp_alias = '{}.{}.tmp'.format(alias, os.getpid())
+    try:
+        os.link(filename, tmp_alias)
+    except OSError:
+        shutil.copyfile(filename, tmp_alias)
+    os.replace(tmp_alias, alias)
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints on a background thread, in the order of the requests. The
+    caller only snapshots the data into CPU memory (see cpu_module and cpu_state),
+    the slow part, i.e. serializing and writing, happens off the training loop.
+    Files are written atomically. Checkpoints of a kind can be retained, keeping
+    either the last N or the best K (lowest score) of them and deleting the others.
+    """
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._retained = {}  # kind -> list of (score, sequence number, filenames)
+        self._sequence = 0
+        self._failed = False  # whether writing failed since the last commit
+
+    def _submit(self, function, *args):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work, daemon=True)
+            self._thread.start()
+        self._queue.put((function, args))
+
+    def _work(self):
+        while True:
+            function, args = self._queue.get()
+            try:
+                function(*args)
+            except Exception as error:
+                self._failed = True
+                print('Checkpoint writing failed:', error)
+            finally:
+                self._queue.task_done()
+
+    def save_module(self, module, filename, aliases=()):
+        """Snapshots the module to the CPU and saves it (as torch.load-able module) in the background.
+        :param aliases: further filenames of the same checkpoint, e.g. for retained copies
+        """
+        self._submit(self._save, cpu_module(module), filename, aliases)
+
+    def save_state(self, state, filename):
+        """Snapshots e.g. an optimizer state_dict to the CPU and saves it in the background."""
+        self._submit(self._save, cpu_state(state), filename, ())
+
+    def write_text(self, encode, filename):
+        """Writes the text returned by encode() in the background; encode must not depend on mutable state."""
+        self._submit(lambda: write_atomic(encode(), filename))
+
+    def commit(self, function, *args):
+        """
+        Calls function(*args) in the background once everything submitted before is written, e.g.
+        to record that a checkpoint is complete. It is not called if writing failed since the last commit.
+        """
+        self._submit(self._commit, function, args)
+
+    def _commit(self, function, args):
+        failed, self._failed = self._failed, False
+        if failed:
+            print('Checkpoint not committed, as writing it failed.')
+        else:
+            function(*args)
+
+    @staticmethod
+    def _save(obj, filename, aliases):
+        save_atomic(obj, filename)
+        for alias in aliases:
+            link_atomic(filename, alias)
+
+    def retain(self, kind, filenames, keep, score=None):
+        """
+        Registers the (submitted) files of a checkpoint of the given kind and, once they
+        are written, deletes the files of older checkpoints of this kind beyond keep.
+        :param score: if given, the checkpoints with the lowest scores are kept, else the last ones
+        """
+        self._sequence += 1
+        self._submit(self._retain, kind, list(filenames), keep, score, self._sequence)
+
+    def _retain(self, kind, filenames, keep, score, sequence):
+        retained = self._retained.setdefault(kind, [])
+        retained.append((score, sequence, filenames))
+        if score is None:
+            retained.sort(key=lambda checkpoint: -checkpoint[1])
+        else:
+            retained.sort(key=lambda checkpoint: (checkpoint[0], -checkpoint[1]))
+        for _, _, removed in retained[keep:]:
+            for filename in removed:
+                if os.path.exists(filename):
+                    os.remove(filename)
+        del retained[keep:]
+
+    def wait(self):
+        """Blocks until all submitted checkpoints are written."""
+        self._queue.join()
@@ -1,18 +1,23 @@
 import os
-import csv
+import hashlib
 import nibabel as nib
 import random
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 from torchvision import transforms
 from torch.utils.data import Dataset, DataLoader
-from torch.utils.data.sampler import SubsetRandomSampler
+from torch.utils.data.dataloader import default_collate
+from torch.utils.data.sampler import Sampler, SubsetRandomSampler
 
 import numpy as np
 import scipy.ndimage as ndi
 from scipy.ndimage.interpolation import map_coordinates
-from scipy.ndimage.filters import gaussian_filter
+from scipy.ndimage.filters import gaussian_filter, gaussian_filter1d
+
+from common.storage import VolumeCache, SampleCache, PackedMask, compact_volume, files_stamp
+from common.manifest import CaseManifest
 
 
 KEY_CASE_ID = 'case_id'
@@ -20,11 +25,20 @@ KEY_CLINICAL_IDX = 'clinical_idx'
 KEY_IMAGES = 'images'
 KEY_LABELS = 'labels'
 KEY_GLOBAL = 'clinical'
+KEY_LABELS_BITS = 'labels_bits'
+KEY_LABELS_SHAPE = 'labels_shape'
+KEY_BBOX = 'bbox'
+KEY_SPACING = 'spacing'
 
 DIM_HORIZONTAL_NUMPY_3D = 0
 DIM_DEPTH_NUMPY_3D = 2
 DIM_CHANNEL_NUMPY_3D = 3
 DIM_CHANNEL_TORCH3D_5 = 1
+DIM_HORIZONTAL_TORCH3D_5 = 4
+
+TRANSFORM_CACHE_MEMORY = 'memory'
+TRANSFORM_CACHE_DISK = 'disk'
+TRANSFORM_CACHE_VERSION = 2  # increased whenever the keys of the cached samples change
 
 
 class StrokeLindaDataset3D(Dataset):
@@ -33,65 +47,264 @@ class StrokeLindaDataset3D(Dataset):
     PATH_CSV = '/share/data_zoe1/lucas/Linda_Segmentations/clinical_cleaned.csv'
     FN_PREFIX = 'train'
     FN_PATTERN = '{1}/{0}{1}{2}.nii.gz'
+    FN_PATTERN_UNCOMPRESSED = '{1}/{0}{1}{2}.nii'
     ROW_OFFSET = 1
     COL_OFFSET = 1
 
     def __init__(self, root_dir=PATH_ROOT, modalities=[], labels=[], clinical=PATH_CSV, transform=None,
-                 single_case_id=None):
+                 single_case_id=None, cache_dir=None, transform_cache=None, lazy=False, decode_threads=1,
+                 image_dtype=np.float32, pack_labels=False):
         self._root_dir = root_dir
-        self._clinical = self._load_clinical_data_from_csv(clinical, row_offset=self.ROW_OFFSET, col_offset=0)
+        self._cache = None
+        if cache_dir is not None:
+            self._cache = VolumeCache(cache_dir)
         self._transform = transform
         self._modalities = modalities
         self._labels = labels
+        self._image_dtype = np.dtype(image_dtype)
+        self._pack_labels = pack_labels
+        self._manifest = CaseManifest.get(clinical, labels + modalities, self._filename, row_offset=self.ROW_OFFSET,
+                                          cache_dir=cache_dir)
+
+        if isinstance(transform, transforms.Compose):
+            check_foreground_patches(transform.transforms)
+
+        self._transform_cache = None
+        if transform_cache is not None:
+            self._init_transform_cache(transform_cache, cache_dir)
+
+        self._lazy = lazy
+        if lazy:
+            assert transform_cache is None, 'Lazy reading cannot be combined with a transform cache.'
+            self._init_lazy_transform()
+
+        self._resident = {}
+
+        self._decode_threads = decode_threads
+        self._executors = {}
+        self._executors_pid = None
+        self._read_ahead = {}
 
         self._item_index_map = []
-        for index in range(len(self._clinical)):
-            case_id = int(self._clinical[index][0])
+        for index in range(len(self._manifest.case_ids)):
+            case_id = int(self._manifest.case_ids[index])
             if single_case_id is not None and single_case_id != case_id:
                 continue
             self._item_index_map.append({KEY_CASE_ID: case_id, KEY_CLINICAL_IDX: index})
 
-    def _load_clinical_data_from_csv(self, filename, col_offset=0, row_offset=0):
-        result = []
-        with open(filename, 'r') as f:
-            rows = csv.reader(f, delimiter=',')
-            for row in rows:
-                if row_offset == 0:
-                    result.append(row[col_offset:])
-                else:
-                    row_offset -= 1
-        return result
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_executors'] = {}  # thread pools are neither picklable nor inherited by worker processes
+        state['_read_ahead'] = {}
+        return state
+
+    def _executor(self, name, n_threads):
+        if self._executors_pid != os.getpid():
+            self._executors = {}
+            self._executors_pid = os.getpid()
+            self._read_ahead = {}
+        if name not in self._executors:
+            self._executors[name] = ThreadPoolExecutor(n_threads)
+        return self._executors[name]
+
+    def missing_files(self, items):
+        """Paths of the modality and label files of the given items that do not exist."""
+        return self._manifest.missing([self._item_index_map[item][KEY_CASE_ID] for item in items])
+
+    def _init_transform_cache(self, mode, cache_dir):
+        """Splits off the leading transforms flagged as CACHEABLE, i.e. deterministic
+        per case. Their output is materialized once per case in memory, or on disk
+        keyed by the transform parameters and the dataset options that change the
+        stored samples, and only the remaining transforms run for every sample.
+        """
+        assert isinstance(self._transform, transforms.Compose), 'Transform cache requires a transforms.Compose chain.'
+        chain = self._transform.transforms
+        n_prefix = 0
+        while n_prefix < len(chain) and getattr(chain[n_prefix], 'CACHEABLE', False):
+            n_prefix += 1
+        self._prefix_transform = transforms.Compose(chain[:n_prefix])
+        self._transform = transforms.Compose(chain[n_prefix:])
+
+        if mode == TRANSFORM_CACHE_DISK:
+            assert cache_dir is not None, 'Transform cache on disk requires a cache_dir.'
+            # everything that changes the stored samples: transforms, volumes, image dtype and label packing
+            key = str([repr(t) for t in chain[:n_prefix]] + self._modalities + self._labels +
+                      [self._image_dtype.str, self._pack_labels, TRANSFORM_CACHE_VERSION])
+            key_dir = os.path.join(cache_dir, 'transforms', hashlib.sha1(key.encode()).hexdigest()[:16])
+            self._transform_cache = SampleCache(key_dir)
+        else:
+            assert mode == TRANSFORM_CACHE_MEMORY, 'Unknown transform cache ' + str(mode)
+            self._transform_cache = SampleCache()
+
+    def _init_lazy_transform(self):
+        """Splits off the leading transforms flagged as LAZY, i.e. able to operate
+        on volumes that are only read region by region. The volumes are opened
+        from uncompressed NIfTI files (see convert_volumes.py) and only the
+        region requested by the lazy transforms is read before the remaining
+        transforms run.
+        """
+        assert isinstance(self._transform, transforms.Compose), 'Lazy reading requires a transforms.Compose chain.'
+        chain = self._transform.transforms
+        n_prefix = 0
+        while n_prefix < len(chain) and getattr(chain[n_prefix], 'LAZY', False):
+            n_prefix += 1
+        self._lazy_transform = transforms.Compose(chain[:n_prefix])
+        self._transform = transforms.Compose(chain[n_prefix:])
+
+    def _filename(self, case_id, suffix, pattern=FN_PATTERN):
+        img_name = pattern.format(self.FN_PREFIX, str(case_id), suffix)
+        return os.path.join(self._root_dir, img_name)
+
+    def _open_image_data(self, case_id, suffix):
+        filename = self._filename(case_id, suffix, self.FN_PATTERN_UNCOMPRESSED)
+        assert os.path.exists(filename), 'Lazy reading requires uncompressed volumes, missing ' + filename
+        return nib.load(filename, mmap=True).dataobj
 
     def _load_image_data_from_nifti(self, case_id, suffix):
-        img_name = self.FN_PATTERN.format(self.FN_PREFIX, str(case_id), suffix)
-        filename = os.path.join(self._root_dir, img_name)
-        img_data = nib.load(filename).get_data()
-        return img_data[:, :, :, np.newaxis]
+        filename = self._filename(case_id, suffix)
+        is_label = suffix in self._labels
+        if self._cache is None:
+            return compact_volume(nib.load(filename).get_data(), is_label)
+        return self._cache.load(case_id, suffix, filename, lambda fn: compact_volume(nib.load(fn).get_data(), is_label))
+
+    def _spacing(self, case_id):
+        """Voxel spacing along X, Y and Z of the volumes of a case, from the manifest, or None if unknown."""
+        suffixes = self._labels + self._modalities
+        if not suffixes:
+            return None
+        spacing = self._manifest.spacing(case_id, suffixes[0])
+        return None if np.any(np.isnan(spacing)) else spacing
 
     def __len__(self):
         return len(self._item_index_map)
 
-    def __getitem__(self, item):
+    def _load_sample(self, item):
         item_id = self._item_index_map[item]
         case_id = item_id[KEY_CASE_ID]
-        clinical_data = self._clinical[item_id[KEY_CLINICAL_IDX]][1:]
+        clinical_data = self._manifest.clinical[item_id[KEY_CLINICAL_IDX]]
 
         result = {KEY_CASE_ID: case_id, KEY_IMAGES: [], KEY_LABELS: [], KEY_GLOBAL: []}
 
-        for value in clinical_data:
-            result[KEY_GLOBAL].append(float(value))
-        if result[KEY_GLOBAL]:
-            result[KEY_GLOBAL] = np.array(result[KEY_GLOBAL]).reshape((1, 1, 1, len(clinical_data)))
+        if len(clinical_data):
+            result[KEY_GLOBAL] = clinical_data.reshape((1, 1, 1, len(clinical_data))).copy()
+
+        spacing = self._spacing(case_id)
+        if spacing is not None:
+            result[KEY_SPACING] = spacing
+
+        if self._lazy:
+            if self._labels:
+                result[KEY_LABELS] = ProxyVolume([self._open_image_data(case_id, l) for l in self._labels])
+            if self._modalities:
+                result[KEY_IMAGES] = ProxyVolume([self._open_image_data(case_id, m) for m in self._modalities],
+                                                 self._image_dtype)
+            return result
+
+        suffixes = self._labels + self._modalities
+        if self._decode_threads > 1 and len(suffixes) > 1:
+            # zlib releases the GIL, so the files of a case are decoded concurrently
+            volumes = list(self._executor('decode', self._decode_threads).map(
+                lambda suffix: self._load_image_data_from_nifti(case_id, suffix), suffixes))
+        else:
+            volumes = [self._load_image_data_from_nifti(case_id, suffix) for suffix in suffixes]
+
+        if self._labels:
+            result[KEY_LABELS] = stack_channels(volumes[:len(self._labels)])
+        if self._modalities:
+            result[KEY_IMAGES] = stack_channels(volumes[len(self._labels):], self._image_dtype)
+
+        return result
+
+    def _load_cached_sample(self, item):
+        case_id = self._item_index_map[item][KEY_CASE_ID]
+
+        def compute():
+            sample = self._prefix_transform(self._load_sample(item))
+            return self._pack_arrays({key: value for key, value in sample.items() if isinstance(value, np.ndarray)})
+
+        filenames = [self._filename(case_id, suffix) for suffix in self._labels + self._modalities]
+        cached = self._transform_cache.get(case_id, files_stamp(filenames), compute)
+
+        result = emptyCopyFromSample({KEY_CASE_ID: case_id})
+        for key, value in self._unpack_arrays(cached).items():
+            result[key] = np.array(value)  # private writable copy for the remaining transforms
+        return result
+
+    def _pack_arrays(self, arrays):
+        """Replaces binary labels by their bit-packed form for caches and resident samples, if pack_labels is set."""
+        labels = arrays.get(KEY_LABELS)
+        if not self._pack_labels or labels is None or not PackedMask.is_packable(labels):
+            return arrays
+        packed = PackedMask.pack(labels)
+        result = {key: value for key, value in arrays.items() if key != KEY_LABELS}
+        result[KEY_LABELS_BITS] = packed.bits
+        result[KEY_LABELS_SHAPE] = np.array(packed.shape)
+        return result
+
+    def _unpack_arrays(self, arrays):
+        if KEY_LABELS_BITS not in arrays:
+            return arrays
+        result = {key: value for key, value in arrays.items() if key not in [KEY_LABELS_BITS, KEY_LABELS_SHAPE]}
+        result[KEY_LABELS] = PackedMask(np.asarray(arrays[KEY_LABELS_BITS]), arrays[KEY_LABELS_SHAPE]).unpack()
+        return result
+
+    def _load_untransformed_sample(self, item):
+        if self._transform_cache is None:
+            return self._load_sample(item)
+        return self._load_cached_sample(item)
+
+    def make_resident(self, items=None):
+        """Loads the given items (default: all) once into shared memory torch tensors.
+        DataLoader workers inherit or receive the shared tensors and read zero-copy
+        numpy views, so memory does not grow with the number of workers. Transforms
+        must therefore return new arrays instead of writing into their input.
+        :param items: dataset indices to keep resident
+        """
+        assert not self._lazy, 'Lazy reading cannot be combined with resident samples.'
+        if items is None:
+            items = range(len(self))
+        for item in items:
+            if item in self._resident:
+                continue
+            sample = self._load_untransformed_sample(item)
+            arrays = self._pack_arrays({key: value for key, value in sample.items() if isinstance(value, np.ndarray)})
+            self._resident[item] = {key: torch.from_numpy(np.array(value)).share_memory_()
+                                    for key, value in arrays.items()}
+
+    def _load_resident_sample(self, item):
+        result = emptyCopyFromSample({KEY_CASE_ID: self._item_index_map[item][KEY_CASE_ID]})
+        arrays = {key: value.numpy() for key, value in self._resident[item].items()}
+        for key, value in self._unpack_arrays(arrays).items():
+            result[key] = value
+        return result
 
-        for label in self._labels:
-            result[KEY_LABELS].append(self._load_image_data_from_nifti(case_id, label))
-        if result[KEY_LABELS]:
-            result[KEY_LABELS] = np.concatenate(result[KEY_LABELS], axis=DIM_CHANNEL_NUMPY_3D)
+    def prefetch(self, items):
+        """Starts loading the given items, e.g. the next cases in sampler order, in a
+        background thread of the calling process, so that __getitem__ finds them loaded.
+        :param items: dataset indices to read ahead
+        """
+        if self._lazy:
+            return
+        executor = self._executor('read_ahead', 1)
+        for item in items:
+            if item not in self._read_ahead and item not in self._resident:
+                self._read_ahead[item] = executor.submit(self._load_untransformed_sample, item)
+
+    def _take_read_ahead(self, item):
+        if self._executors_pid != os.getpid() or item not in self._read_ahead:
+            return None
+        return self._read_ahead.pop(item).result()
 
-        for modality in self._modalities:
-            result[KEY_IMAGES].append(self._load_image_data_from_nifti(case_id, modality))
-        if result[KEY_IMAGES]:
-            result[KEY_IMAGES] = np.concatenate(result[KEY_IMAGES], axis=DIM_CHANNEL_NUMPY_3D)
+    def __getitem__(self, item):
+        if item in self._resident:
+            result = self._load_resident_sample(item)
+        else:
+            result = self._take_read_ahead(item)
+            if result is None:
+                result = self._load_untransformed_sample(item)
+
+        if self._lazy:
+            result = materialize_sample(self._lazy_transform(result))
 
         if self._transform:
             result = self._transform(result)
@@ -99,30 +312,191 @@ class StrokeLindaDataset3D(Dataset):
         return result
 
 
+def materialize_sample(sample):
+    """Reads the lazy volumes of a sample, or of the samples of a list (see PatchesPerCase), into numpy arrays."""
+    if isinstance(sample, list):
+        return [materialize_sample(item) for item in sample]
+    result = dict(sample)
+    for key in [KEY_IMAGES, KEY_LABELS]:
+        if isinstance(result[key], LazyVolume):
+            result[key] = result[key].materialize()
+    return result
+
+
 def emptyCopyFromSample(sample):
     result = {KEY_CASE_ID: int(sample[KEY_CASE_ID]), KEY_IMAGES: [], KEY_LABELS: [], KEY_GLOBAL: []}
+    if KEY_BBOX in sample:
+        result[KEY_BBOX] = sample[KEY_BBOX]
+    if KEY_SPACING in sample:
+        result[KEY_SPACING] = sample[KEY_SPACING]
+    return result
+
+
+# Volumes XxYxZxC are kept in canonical layout, i.e. Fortran order, which is the
+# C-contiguous CxZxYxX layout of the torch tensors, so that ToTensor does not copy.
+# Labels stay uint8 and images float32 (or float16); interpolating transforms
+# return float32 for integer volumes, and batch_to_dtype converts to the model
+# dtype once per collated batch.
+
+
+def stack_channels(volumes, dtype=None):
+    """Stacks volumes XxYxZ into one volume XxYxZxC in canonical layout."""
+    if dtype is None:
+        dtype = np.result_type(*volumes)
+    result = np.empty(volumes[0].shape[:3] + (len(volumes),), dtype=dtype, order='F')
+    for c, volume in enumerate(volumes):
+        result[:, :, :, c] = volume
+    return result
+
+
+def interpolation_dtype(dtype):
+    """Dtype in which a volume is interpolated: float64 is kept, anything else is computed in float32."""
+    return np.float64 if dtype == np.float64 else np.float32
+
+
+def output_dtype(dtype):
+    """Dtype of an interpolated volume: floating point inputs keep their dtype, integer labels become float32."""
+    return dtype if np.issubdtype(dtype, np.floating) else np.float32
+
+
+def flatten_samples(samples):
+    """Flattens the lists of samples returned by PatchesPerCase into a single list of samples."""
+    return [sample for item in samples for sample in (item if isinstance(item, list) else [item])]
+
+
+def collate_samples(samples):
+    """Collates samples as default_collate, with the patches of a case as separate samples."""
+    return default_collate(flatten_samples(samples))
+
+
+def collate_batch(samples):
+    """Collates samples as collate_samples, but packs binary uint8 labels to 1 bit
+    per voxel, so that only the packed batch is passed from the loader workers.
+    """
+    samples = flatten_samples(samples)
+    labels = [sample[KEY_LABELS] for sample in samples]
+    if not all(torch.is_tensor(label) and PackedMask.is_packable(label.numpy()) for label in labels):
+        return default_collate(samples)
+    batch = default_collate([{key: value for key, value in sample.items() if key != KEY_LABELS} for sample in samples])
+    bits = [torch.from_numpy(np.packbits(label.contiguous().numpy().ravel())) for label in labels]
+    batch[KEY_LABELS] = PackedMask(torch.stack(bits), (len(labels),) + tuple(labels[0].size()))
+    return batch
+
+
+def unpack_batch(batch):
+    """Unpacks the bit-packed labels of a collated batch, vectorized over the whole batch."""
+    labels = batch[KEY_LABELS]
+    if not isinstance(labels, PackedMask):
+        return batch
+    shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=labels.bits.device)
+    bits = (labels.bits.unsqueeze(-1) >> shifts) & 1
+    n_voxels = int(np.prod(labels.shape[1:]))
+    result = dict(batch)
+    result[KEY_LABELS] = bits.view(labels.shape[0], -1)[:, :n_voxels].reshape(labels.shape)
+    return result
+
+
+def batch_spacing(batch):
+    """Voxel spacing of the samples of a collated batch along the axes Z, Y, X of its tensors, (B, 3), or None."""
+    if KEY_SPACING not in batch:
+        return None
+    spacing = batch[KEY_SPACING]
+    spacing = spacing.numpy() if torch.is_tensor(spacing) else np.asarray(spacing)
+    return spacing[:, ::-1].astype(np.float64)
+
+
+def batch_to_dtype(batch, dtype=torch.float32):
+    """Converts the images, labels and clinical data of a collated batch to the model dtype."""
+    result = unpack_batch(batch)
+    for key in [KEY_IMAGES, KEY_LABELS, KEY_GLOBAL]:
+        if torch.is_tensor(result[key]) and result[key].dtype != dtype:
+            result[key] = result[key].to(dtype)
     return result
 
 
 def set_np_seed(workerid):
+    """Seeds NumPy and Python random of a DataLoader worker from its torch seed,
+    which is distinct per worker and epoch, so workers draw different augmentations.
+    """
     torch_seed = torch.initial_seed()
     numpy_seed = torch_seed % np.iinfo(np.int32).max
     np.random.seed(numpy_seed)
+    random.seed(torch_seed)
+
+
+def loader_kwargs(num_workers=0, pin_memory=False, prefetch_factor=2, persistent_workers=False, pack_labels=False):
+    """Keyword arguments for DataLoader. Prefetching and persistent workers only apply to worker processes."""
+    kwargs = {'num_workers': num_workers, 'pin_memory': pin_memory, 'worker_init_fn': set_np_seed,
+              'collate_fn': collate_batch if pack_labels else collate_samples}
+    if num_workers > 0:
+        kwargs['prefetch_factor'] = prefetch_factor
+        kwargs['persistent_workers'] = persistent_workers
+    return kwargs
+
+
+class ReadAheadSampler(Sampler):
+    """Wraps a sampler and lets the dataset read ahead the next n_items in sampler order.
+    Only effective without DataLoader workers, since the dataset must be accessed in
+    the process iterating the sampler; workers are kept busy by prefetch_factor instead.
+    """
+    def __init__(self, sampler, dataset, n_items):
+        self._sampler = sampler
+        self._dataset = dataset
+        self._n_items = n_items
+        self.indices = sampler.indices
+
+    def __iter__(self):
+        order = list(self._sampler)
+        for i, item in enumerate(order):
+            self._dataset.prefetch(order[i + 1:i + 1 + self._n_items])
+            yield item
+
+    def __len__(self):
+        return len(self._sampler)
+
+
+def read_ahead_sampler(sampler, dataset, read_ahead=0, num_workers=0):
+    if read_ahead > 0 and num_workers == 0:
+        return ReadAheadSampler(sampler, dataset, read_ahead)
+    return sampler
+
+
+class InfiniteSampler(Sampler):
+    """Iterates a sampler over and over (reshuffled per pass), so that the DataLoader
+    workers keep running for step-based training. len() is the length of one pass.
+    """
+    def __init__(self, sampler):
+        self._sampler = sampler
+        self.indices = sampler.indices
+
+    def __iter__(self):
+        while True:
+            for item in self._sampler:
+                yield item
+
+    def __len__(self):
+        return len(self._sampler)
 
 
 def split_data_loader3D(modalities, labels, indices, batch_size, random_seed=None, valid_size=0.5, shuffle=True,
-                        num_workers=4, pin_memory=False, train_transform=[], valid_transform=[]):
+                        num_workers=4, pin_memory=False, train_transform=[], valid_transform=[], prefetch_factor=2,
+                        persistent_workers=False, resident=False, read_ahead=0, pack_labels=False, infinite=False,
+                        **dataset_kwargs):
     assert ((valid_size >= 0) and (valid_size <= 1)), "[!] valid_size should be in the range [0, 1]."
     assert train_transform, "You must provide at least a numpy-to-torch transformation."
     assert valid_transform, "You must provide at least a numpy-to-torch transformation."
 
     # load the dataset
     dataset_train = StrokeLindaDataset3D(modalities=modalities, labels=labels,
-                                         transform=transforms.Compose(train_transform))
+                                         transform=transforms.Compose(train_transform), pack_labels=pack_labels,
+                                         **dataset_kwargs)
     dataset_valid = StrokeLindaDataset3D(modalities=modalities, labels=labels,
-                                         transform=transforms.Compose(valid_transform))
+                                         transform=transforms.Compose(valid_transform), pack_labels=pack_labels,
+                                         **dataset_kwargs)
 
     items = list(set(range(len(dataset_train))).intersection(set(indices)))
+    missing = dataset_train.missing_files(items)
+    assert not missing, 'Missing files: ' + ', '.join(missing)
     num_train = len(items)
     split = int(np.floor(valid_size * num_train))
 
@@ -132,122 +506,162 @@ def split_data_loader3D(modalities, labels, indices, batch_size, random_seed=Non
 
     train_idx, valid_idx = items[split:], items[:split]
 
-    train_sampler = SubsetRandomSampler(train_idx)
-    valid_sampler = SubsetRandomSampler(valid_idx)
+    if resident:
+        dataset_train.make_resident(train_idx)
+        dataset_valid.make_resident(valid_idx)
+
+    train_sampler = read_ahead_sampler(SubsetRandomSampler(train_idx), dataset_train, read_ahead, num_workers)
+    if infinite:
+        train_sampler = InfiniteSampler(train_sampler)
+    valid_sampler = read_ahead_sampler(SubsetRandomSampler(valid_idx), dataset_valid, read_ahead, num_workers)
+
+    kwargs = loader_kwargs(num_workers, pin_memory, prefetch_factor, persistent_workers, pack_labels)
 
     train_loader = DataLoader(dataset_train,
-                    batch_size=batch_size, sampler=train_sampler,
-                    num_workers=num_workers, pin_memory=pin_memory,
-                    worker_init_fn=set_np_seed)
+                    batch_size=batch_size, sampler=train_sampler, **kwargs)
 
     valid_loader = DataLoader(dataset_valid,
-                    batch_size=batch_size, sampler=valid_sampler,
-                    num_workers=num_workers, pin_memory=pin_memory)
+                    batch_size=batch_size, sampler=valid_sampler, **kwargs)
 
     return (train_loader, valid_loader)
 
 
 def single_data_loader3D(modalities, labels, indices, batch_size, random_seed=None, valid_size=0.5, shuffle=True,
-                         num_workers=4, pin_memory=False, train_transform=[]):
+                         num_workers=4, pin_memory=False, train_transform=[], prefetch_factor=2,
+                         persistent_workers=False, resident=False, read_ahead=0, pack_labels=False, infinite=False,
+                         **dataset_kwargs):
     assert ((valid_size >= 0) and (valid_size <= 1)), "[!] valid_size should be in the range [0, 1]."
     assert train_transform, "You must provide at least a numpy-to-torch transformation."
 
     # load the dataset
     dataset_train = StrokeLindaDataset3D(modalities=modalities, labels=labels,
-                                         transform=transforms.Compose(train_transform))
+                                         transform=transforms.Compose(train_transform), pack_labels=pack_labels,
+                                         **dataset_kwargs)
 
     items = list(set(range(len(dataset_train))).intersection(set(indices)))
+    missing = dataset_train.missing_files(items)
+    assert not missing, 'Missing files: ' + ', '.join(missing)
 
     if shuffle == True:
         random_state = np.random.RandomState(random_seed)
         random_state.shuffle(items)
 
-    train_sampler = SubsetRandomSampler(items)
+    if resident:
+        dataset_train.make_resident(items)
+
+    train_sampler = read_ahead_sampler(SubsetRandomSampler(items), dataset_train, read_ahead, num_workers)
+    if infinite:
+        train_sampler = InfiniteSampler(train_sampler)
 
     train_loader = DataLoader(dataset_train,
                     batch_size=batch_size, sampler=train_sampler,
-                    num_workers=num_workers, pin_memory=pin_memory,
-                    worker_init_fn=set_np_seed)
+                    **loader_kwargs(num_workers, pin_memory, prefetch_factor, persistent_workers, pack_labels))
 
     return train_loader
 
 
 def get_stroke_shape_training_data(modalities, labels, train_transform, valid_transform, fold_indices, ratio, seed=4,
-                                   batchsize=2, split=True):
+                                   batchsize=2, split=True, num_workers=0, pin_memory=False,
+                                   prefetch_factor=2, persistent_workers=False, **dataset_kwargs):
     if split:
         return split_data_loader3D(modalities, labels, fold_indices, batchsize, random_seed=seed,
                                    valid_size=ratio, train_transform=train_transform,
-                                   valid_transform=valid_transform, num_workers=0)
+                                   valid_transform=valid_transform, num_workers=num_workers,
+                                   pin_memory=pin_memory, prefetch_factor=prefetch_factor,
+                                   persistent_workers=persistent_workers, **dataset_kwargs)
     return single_data_loader3D(modalities, labels, fold_indices, batchsize, random_seed=seed,
-                                valid_size=ratio, train_transform=train_transform, num_workers=0), None
+                                valid_size=ratio, train_transform=train_transform, num_workers=num_workers,
+                                pin_memory=pin_memory, prefetch_factor=prefetch_factor,
+                                persistent_workers=persistent_workers, **dataset_kwargs), None
 
 
 def get_stroke_prediction_training_data(modalities, labels, train_transform, valid_transform, fold_indices, ratio,
-                                        seed=4, batchsize=2, split=True):
+                                        seed=4, batchsize=2, split=True, num_workers=0, pin_memory=False,
+                                        prefetch_factor=2, persistent_workers=False, **dataset_kwargs):
     if split:
         return split_data_loader3D(modalities, labels, fold_indices, batchsize, random_seed=seed,
                                    valid_size=ratio, train_transform=train_transform,
-                                   valid_transform=valid_transform, num_workers=0)
+                                   valid_transform=valid_transform, num_workers=num_workers,
+                                   pin_memory=pin_memory, prefetch_factor=prefetch_factor,
+                                   persistent_workers=persistent_workers, **dataset_kwargs)
     return single_data_loader3D(modalities, labels, fold_indices, batchsize, random_seed=seed,
-                                valid_size=ratio, train_transform=train_transform, num_workers=0), None
+                                valid_size=ratio, train_transform=train_transform, num_workers=num_workers,
+                                pin_memory=pin_memory, prefetch_factor=prefetch_factor,
+                                persistent_workers=persistent_workers, **dataset_kwargs), None
 
 
 def get_testdata(modalities, labels, indices, random_seed=None, shuffle=True, num_workers=4, pin_memory=False,
-                 transform=[]):
+                 transform=[], prefetch_factor=2, persistent_workers=False, resident=False, read_ahead=0,
+                 pack_labels=False, **dataset_kwargs):
     assert transform, "You must provide at least a numpy-to-torch transformation."
 
-    dataset = StrokeLindaDataset3D(modalities=modalities, labels=labels, transform=transforms.Compose(transform))
+    dataset = StrokeLindaDataset3D(modalities=modalities, labels=labels, transform=transforms.Compose(transform),
+                                   pack_labels=pack_labels, **dataset_kwargs)
 
     items = list(set(range(len(dataset))).intersection(set(indices)))
+    missing = dataset.missing_files(items)
+    assert not missing, 'Missing files: ' + ', '.join(missing)
 
     if shuffle == True:
         random_state = np.random.RandomState(random_seed)
         random_state.shuffle(items)
 
-    sampler = SubsetRandomSampler(items)
+    if resident:
+        dataset.make_resident(items)
+
+    sampler = read_ahead_sampler(SubsetRandomSampler(items), dataset, read_ahead, num_workers)
 
-    loader = DataLoader(dataset, batch_size=1, sampler=sampler, num_workers=num_workers, pin_memory=pin_memory,
-                        worker_init_fn=set_np_seed) # important to have batchsize=1 because metrics is computed on batch
+    loader = DataLoader(dataset, batch_size=1, sampler=sampler,
+                        **loader_kwargs(num_workers, pin_memory, prefetch_factor, persistent_workers, pack_labels)) # important to have batchsize=1 because metrics is computed on batch
 
     return loader
 
 
 class HemisphericFlipFixedToCaseId(object):
     """Flip numpy images along X-axis."""
+    CACHEABLE = True
+    LAZY = True
 
     def __init__(self, split_id):
         self.split_id = split_id
 
+    def __repr__(self):
+        return '{}(split_id={})'.format(type(self).__name__, self.split_id)
+
     def __call__(self, sample):
         if int(sample[KEY_CASE_ID]) > self.split_id:
             result = emptyCopyFromSample(sample)
             if sample[KEY_IMAGES] != []:
-                result[KEY_IMAGES] = np.flip(sample[KEY_IMAGES], DIM_HORIZONTAL_NUMPY_3D).copy()
+                result[KEY_IMAGES] = flip_horizontal(sample[KEY_IMAGES])
             if sample[KEY_LABELS] != []:
-                result[KEY_LABELS] = np.flip(sample[KEY_LABELS], DIM_HORIZONTAL_NUMPY_3D).copy()
+                result[KEY_LABELS] = flip_horizontal(sample[KEY_LABELS])
             if sample[KEY_GLOBAL] != []:
-                result[KEY_GLOBAL] = np.flip(sample[KEY_GLOBAL], DIM_HORIZONTAL_NUMPY_3D).copy()
+                result[KEY_GLOBAL] = flip_horizontal(sample[KEY_GLOBAL])
             return result
         return sample
 
 
 class HemisphericFlip(object):
     """Flip numpy images along X-axis."""
+    LAZY = True
+
     def __call__(self, sample):
         if random.random() > 0.5:
             result = emptyCopyFromSample(sample)
             if sample[KEY_IMAGES] != []:
-                result[KEY_IMAGES] = np.flip(sample[KEY_IMAGES], DIM_HORIZONTAL_NUMPY_3D).copy()
+                result[KEY_IMAGES] = flip_horizontal(sample[KEY_IMAGES])
             if sample[KEY_LABELS] != []:
-                result[KEY_LABELS] = np.flip(sample[KEY_LABELS], DIM_HORIZONTAL_NUMPY_3D).copy()
+                result[KEY_LABELS] = flip_horizontal(sample[KEY_LABELS])
             if sample[KEY_GLOBAL] != []:
-                result[KEY_GLOBAL] = np.flip(sample[KEY_GLOBAL], DIM_HORIZONTAL_NUMPY_3D).copy()
+                result[KEY_GLOBAL] = flip_horizontal(sample[KEY_GLOBAL])
             return result
         return sample
 
 
 class RandomPatch(object):
     """Random patches of certain size."""
+    LAZY = True
+
     def __init__(self, w, h, d, pad_x, pad_y, pad_z):
         self._padx = pad_x
         self._pady = pad_y
@@ -256,12 +670,12 @@ class RandomPatch(object):
         self._h = h
         self._d = d
 
-    def __call__(self, sample):
+    def _origin(self, sample):
         sx, sy, sz, _ = sample[KEY_IMAGES].shape
+        return random.randint(0, sx - self._w), random.randint(0, sy - self._h), random.randint(0, sz - self._d)
 
-        rand_x = random.randint(0, sx - self._w)
-        rand_y = random.randint(0, sy - self._h)
-        rand_z = random.randint(0, sz - self._d)
+    def __call__(self, sample):
+        rand_x, rand_y, rand_z = self._origin(sample)
 
         result = emptyCopyFromSample(sample)
         if sample[KEY_IMAGES] != []:
@@ -277,19 +691,216 @@ class RandomPatch(object):
         return result
 
 
+class PatchesPerCase(object):
+    """Applies a random transform, e.g. RandomPatch followed by ToTensor, n_patches
+    times to the same loaded case and returns the list of results, which the
+    DataLoader collates as separate samples (see collate_samples). Thus loading,
+    resampling and padding of a case is shared by n_patches training examples.
+    On lazy volumes, the leading LAZY transforms of a transforms.Compose run for
+    every draw, so that only the region of each patch is read.
+    """
+    LAZY = True
+
+    def __init__(self, n_patches, transform):
+        self._n_patches = n_patches
+        self.transforms = transform.transforms if isinstance(transform, transforms.Compose) else [transform]
+        n_lazy = 0
+        while n_lazy < len(self.transforms) and getattr(self.transforms[n_lazy], 'LAZY', False):
+            n_lazy += 1
+        self._lazy_transform = transforms.Compose(self.transforms[:n_lazy])
+        self._transform = transforms.Compose(self.transforms[n_lazy:])
+
+    def _draw(self, sample):
+        return self._transform(materialize_sample(self._lazy_transform(sample)))
+
+    def __call__(self, sample):
+        return [self._draw(sample) for _ in range(self._n_patches)]
+
+
+def cases_per_batch(batch_size, n_patches):
+    """Number of cases of a batch of about batch_size patches with n_patches per case (see PatchesPerCase),
+    at least 2, as the Learner requires more than one sample per batch for normalization layers.
+    """
+    return max(2, batch_size // n_patches)
+
+
+class ForegroundIndex(object):
+    """Foreground voxels of each label channel of a case, i.e. their flat indices
+    (Fortran order) into the XxYxZ label volume, their bounding boxes and volumes.
+    """
+    def __init__(self, labels, threshold=0.5):
+        self.shape = labels.shape[:3]
+        self.coords = []
+        self.bboxes = []
+        self.volumes = []
+        for channel in range(labels.shape[DIM_CHANNEL_NUMPY_3D]):
+            mask = labels[:, :, :, channel] > threshold
+            coords = np.flatnonzero(mask.ravel(order='F'))
+            self.coords.append(coords.astype(np.int32) if mask.size < 2 ** 31 else coords)
+            self.bboxes.append(bounding_box(mask))
+            self.volumes.append(len(coords))
+
+    def voxel(self, channel):
+        """Random foreground voxel (x, y, z) of the given label channel."""
+        flat = self.coords[channel][random.randrange(self.volumes[channel])]
+        return tuple(int(v) for v in np.unravel_index(flat, self.shape, order='F'))
+
+
+class ForegroundPatch(RandomPatch):
+    """Random patches of certain size, of which a fraction foreground_ratio is drawn
+    such that the label region of the patch contains a random foreground voxel of
+    a random (non-empty) label channel. The remaining patches are drawn uniformly
+    as in RandomPatch. With cache_index, the foreground index of a case is built
+    once per process, which is only valid if all preceding transforms are
+    deterministic per case (see check_foreground_patches); otherwise it is built
+    from every sample.
+    """
+    def __init__(self, w, h, d, pad_x, pad_y, pad_z, foreground_ratio=0.5, channels=None, threshold=0.5,
+                 cache_index=True):
+        RandomPatch.__init__(self, w, h, d, pad_x, pad_y, pad_z)
+        self._foreground_ratio = foreground_ratio
+        self._channels = channels
+        self._threshold = threshold
+        self.cache_index = cache_index
+        self._index = {}
+
+    def foreground_index(self, sample):
+        case_id = int(sample[KEY_CASE_ID])
+        if self.cache_index and case_id in self._index:
+            return self._index[case_id]
+        labels = sample[KEY_LABELS]
+        if isinstance(labels, LazyVolume):
+            labels = labels.materialize()
+        index = ForegroundIndex(labels, self._threshold)
+        if self.cache_index:
+            self._index[case_id] = index
+        return index
+
+    def _origin(self, sample):
+        if random.random() >= self._foreground_ratio:
+            return RandomPatch._origin(self, sample)
+        index = self.foreground_index(sample)
+        channels = range(len(index.volumes)) if self._channels is None else self._channels
+        channels = [channel for channel in channels if index.volumes[channel] > 0]
+        if not channels:
+            return RandomPatch._origin(self, sample)
+
+        voxel = index.voxel(random.choice(channels))
+        origin = []
+        for v, size, patch, pad in zip(voxel, sample[KEY_IMAGES].shape[:3], (self._w, self._h, self._d),
+                                       (self._padx, self._pady, self._padz)):
+            low = max(0, v - (patch - 2 * pad) + 1)  # label region [origin, origin + patch - 2 * pad) contains v
+            high = min(v, size - patch)
+            origin.append(random.randint(low, high) if low <= high else high)
+        return tuple(origin)
+
+
+def check_foreground_patches(chain):
+    """Asserts that ForegroundPatch transforms of a chain (also within PatchesPerCase) that cache the
+    foreground index per case only follow transforms flagged as CACHEABLE, i.e. deterministic per case,
+    as random or spatial transforms such as HemisphericFlip or ElasticDeform would invalidate the index.
+    """
+    flat = []
+    for transform in chain:
+        flat += transform.transforms if isinstance(transform, PatchesPerCase) else [transform]
+    for position, transform in enumerate(flat):
+        if isinstance(transform, ForegroundPatch) and transform.cache_index:
+            for previous in flat[:position]:
+                assert getattr(previous, 'CACHEABLE', False), \
+                    'ForegroundPatch after ' + type(previous).__name__ + ' requires cache_index=False.'
+
+
+class CropToBoundingBox(object):
+    """Crop images and labels to the bounding box of the brain, i.e. of all voxels
+    that differ from background in any image channel, extended by margin voxels.
+    The box starts at a multiple of stride and its size is rounded up to a multiple
+    of stride (or ends at the volume border), so that a model with that total
+    stride sees the same pooling grid as on the full volume. The box is kept as
+    KEY_BBOX, an array of (start, stop, full size) per axis, for paste_bounding_box.
+    Apply after flipping and resampling, before padding.
+    """
+    CACHEABLE = True
+
+    def __init__(self, margin=0, stride=4, background=0):
+        self._margin = margin
+        self._stride = stride
+        self._background = background
+        self._boxes = {}  # per case id, computed once per process
+
+    def __repr__(self):
+        return '{}(margin={}, stride={}, background={})'.format(type(self).__name__, self._margin, self._stride,
+                                                                self._background)
+
+    def __call__(self, sample):
+        case_id = int(sample[KEY_CASE_ID])
+        if case_id not in self._boxes:
+            foreground = np.any(sample[KEY_IMAGES] != self._background, axis=DIM_CHANNEL_NUMPY_3D)
+            self._boxes[case_id] = bounding_box(foreground, self._margin, self._stride)
+        bbox = self._boxes[case_id]
+        region = tuple(slice(start, stop) for start, stop, _ in bbox)
+
+        result = emptyCopyFromSample(sample)
+        result[KEY_BBOX] = bbox
+        if sample[KEY_IMAGES] != []:
+            result[KEY_IMAGES] = sample[KEY_IMAGES][region]
+        if sample[KEY_LABELS] != []:
+            result[KEY_LABELS] = sample[KEY_LABELS][region]
+        result[KEY_GLOBAL] = sample[KEY_GLOBAL]
+        return result
+
+
+def bounding_box(mask, margin=0, stride=1):
+    """Bounding box of the non-zero voxels of a 3D mask, as array of (start, stop, size) per axis."""
+    bbox = np.zeros((mask.ndim, 3), dtype=np.int64)
+    for axis, size in enumerate(mask.shape):
+        indices = np.flatnonzero(np.any(mask, axis=tuple(a for a in range(mask.ndim) if a != axis)))
+        if len(indices) == 0:
+            start, stop = 0, size
+        else:
+            start = max(0, indices[0] - margin) // stride * stride
+            stop = min(size, indices[-1] + 1 + margin)
+            stop = min(size, start + -(-(stop - start) // stride) * stride)
+        bbox[axis] = start, stop, size
+    return bbox
+
+
+def paste_bounding_box(volume, bbox, fill_value=0):
+    """Inserts a volume cropped by CropToBoundingBox into a volume of the full size; trailing axes are kept."""
+    bbox = np.asarray(bbox)
+    result = np.full(tuple(bbox[:, 2]) + volume.shape[len(bbox):], fill_value, dtype=volume.dtype)
+    result[tuple(slice(start, stop) for start, stop, _ in bbox)] = volume
+    return result
+
+
 class PadImages(object):
     """Pad images with constant pad_value in all 6 directions (3D)."""
+    CACHEABLE = True
+    LAZY = True
+
     def __init__(self, pad_x, pad_y, pad_z, pad_value=0):
         self._padx = pad_x
         self._pady = pad_y
         self._padz = pad_z
         self._pad_value = float(pad_value)
 
+    def __repr__(self):
+        return '{}(pad={}, pad_value={})'.format(type(self).__name__, (self._padx, self._pady, self._padz),
+                                                 self._pad_value)
+
     def __call__(self, sample):
+        if isinstance(sample[KEY_IMAGES], LazyVolume):
+            result = emptyCopyFromSample(sample)
+            result[KEY_IMAGES] = PaddedVolume(sample[KEY_IMAGES], (self._padx, self._pady, self._padz),
+                                              self._pad_value)
+            result[KEY_LABELS] = sample[KEY_LABELS]
+            result[KEY_GLOBAL] = sample[KEY_GLOBAL]
+            return result
+
         sx, sy, sz, sc = sample[KEY_IMAGES].shape
         result = emptyCopyFromSample(sample)
         if sample[KEY_IMAGES] != []:
-            result[KEY_IMAGES] = np.ones((sx + 2 * self._padx, sy + 2 * self._pady, sz + 2 * self._padz, sc), dtype=np.float32) * self._pad_value
+            result[KEY_IMAGES] = np.full((sx + 2 * self._padx, sy + 2 * self._pady, sz + 2 * self._padz, sc), self._pad_value,
+                                         dtype=output_dtype(sample[KEY_IMAGES].dtype), order='F')
             result[KEY_IMAGES][self._padx:-self._padx, self._pady:-self._pady, self._padz:-self._padz, :] = sample[KEY_IMAGES]
         result[KEY_LABELS] = sample[KEY_LABELS]
         result[KEY_GLOBAL] = sample[KEY_GLOBAL]
@@ -302,11 +913,11 @@ class ToTensor(object):
     def __call__(self, sample):
         result = emptyCopyFromSample(sample)
         if sample[KEY_IMAGES] != []:
-            result[KEY_IMAGES] = torch.from_numpy(sample[KEY_IMAGES]).permute(3, 2, 1, 0)
+            result[KEY_IMAGES] = torch.from_numpy(np.asfortranarray(sample[KEY_IMAGES]).T)  # zero-copy if canonical
         if sample[KEY_LABELS] != []:
-            result[KEY_LABELS] = torch.from_numpy(sample[KEY_LABELS]).permute(3, 2, 1, 0)
+            result[KEY_LABELS] = torch.from_numpy(np.asfortranarray(sample[KEY_LABELS]).T)
         if sample[KEY_GLOBAL] != []:
-            result[KEY_GLOBAL] = torch.from_numpy(sample[KEY_GLOBAL]).permute(3, 2, 1, 0)
+            result[KEY_GLOBAL] = torch.from_numpy(np.asfortranarray(sample[KEY_GLOBAL]).T)
         return result
 
 
@@ -316,12 +927,90 @@ class ElasticDeform(object):
        Neural Networks applied to Visual Document Analysis", in Proc.
        of the International Conference on Document Analysis and
        Recognition, 2003.
+       The fast mode samples the displacements on a coarse control grid
+       with grid_spacing voxels, upsamples them and warps all channels
+       with the same coordinates (optionally on n_threads threads).
+       Random numbers are drawn from random_state, or from the global
+       numpy random state, which is seeded per DataLoader worker.
     """
+    # Displacements along Z relative to X and Y: the ratio of slices to in-plane voxels of the
+    # volumes (28 / 128), as they cover a similar extent in all directions with thicker slices.
+    Z_SCALE = 0.22
+    _identity_grids = {}  # identity coordinates per volume shape, shared by all instances
 
-    def __init__(self, alpha=100, sigma=4, apply_to_images=False):
+    def __init__(self, alpha=100, sigma=4, apply_to_images=False, fast=False, grid_spacing=4, n_threads=1,
+                 random_state=None):
         self._alpha = alpha
         self._sigma = sigma
         self._apply_to_images = apply_to_images
+        self._fast = fast
+        self._grid_spacing = grid_spacing
+        self._n_threads = n_threads
+        self._random_state = random_state
+        self._executor = None
+        self._executor_pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_executor'] = None  # thread pools are neither picklable nor inherited by worker processes
+        return state
+
+    def _get_random_state(self):
+        if self._random_state is not None:
+            return self._random_state
+        return np.random.RandomState(np.random.randint(np.iinfo(np.int32).max))
+
+    def _get_identity_grid(self, shape):
+        if shape not in self._identity_grids:
+            self._identity_grids[shape] = np.indices(shape, dtype=np.float32)
+        return self._identity_grids[shape]
+
+    def _map(self, function, iterable):
+        if self._n_threads < 2:
+            return list(map(function, iterable))
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(self._n_threads)
+            self._executor_pid = os.getpid()
+        return list(self._executor.map(function, iterable))
+
+    def displacement(self, shape, random_state):
+        """Smooth random displacements 3xXxYxZ sampled on a coarse control grid
+        and upsampled, scaled to the amplitude of the full resolution fields.
+        """
+        coarse_shape = tuple(int(np.ceil(size / self._grid_spacing)) + 1 for size in shape)
+        coarse_sigma = self._sigma / self._grid_spacing
+        gain = gaussian_noise_gain(self._sigma) / gaussian_noise_gain(coarse_sigma)
+        zoom = [size / coarse_size for size, coarse_size in zip(shape, coarse_shape)]
+
+        result = np.empty((3,) + tuple(shape), dtype=np.float32)
+        for dim, scale in enumerate([1, 1, self.Z_SCALE]):
+            coarse = gaussian_filter((random_state.rand(*coarse_shape) * 2 - 1), coarse_sigma, mode="constant", cval=0)
+            ndi.zoom(coarse * (self._alpha * gain * scale), zoom, output=result[dim], order=1)
+        return result
+
+    def warp(self, volume, coordinates):
+        """Warps all channels of a volume XxYxZxC with the same coordinates."""
+        output = np.empty(volume.shape[::-1], dtype=interpolation_dtype(volume.dtype))  # canonical CxZxYxX
+
+        def warp_channel(c):
+            map_coordinates(volume[:, :, :, c].astype(output.dtype, copy=False), coordinates, output=output[c].T,
+                            order=1)
+
+        self._map(warp_channel, range(volume.shape[DIM_CHANNEL_NUMPY_3D]))
+        return output.T.astype(output_dtype(volume.dtype), copy=False)
+
+    def _call_fast(self, sample):
+        shape = sample[KEY_LABELS].shape[:3]
+        coordinates = self._get_identity_grid(shape) + self.displacement(shape, self._get_random_state())
+
+        result = emptyCopyFromSample(sample)
+        result[KEY_LABELS] = self.warp(sample[KEY_LABELS], coordinates)
+        result[KEY_IMAGES] = sample[KEY_IMAGES]
+        if self._apply_to_images and sample[KEY_IMAGES] != []:
+            assert sample[KEY_IMAGES].shape[:3] == shape, 'Images and labels must be of same size to be deformed.'
+            result[KEY_IMAGES] = self.warp(sample[KEY_IMAGES], coordinates)
+        result[KEY_GLOBAL] = sample[KEY_GLOBAL]
+        return result
 
     def elastic_transform(self, image, alpha=100, sigma=4, random_state=None):
         new_seed = datetime.datetime.now().second + datetime.datetime.now().microsecond
@@ -331,7 +1020,7 @@ class ElasticDeform(object):
         shape = image.shape
         dx = gaussian_filter((random_state.rand(*shape) * 2 - 1), sigma, mode="constant", cval=0) * alpha
         dy = gaussian_filter((random_state.rand(*shape) * 2 - 1), sigma, mode="constant", cval=0) * alpha
-        dz = gaussian_filter((random_state.rand(*shape) * 2 - 1), sigma, mode="constant", cval=0) * alpha * 0.22  # 28/128  TODO: correct according to voxel spacing
+        dz = gaussian_filter((random_state.rand(*shape) * 2 - 1), sigma, mode="constant", cval=0) * alpha * self.Z_SCALE
 
         x, y, z = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), np.arange(shape[2]))
         indices = np.reshape(y + dy, (-1, 1)), np.reshape(x + dx, (-1, 1)), np.reshape(z + dz, (-1, 1))
@@ -339,6 +1028,13 @@ class ElasticDeform(object):
         return map_coordinates(image, indices, order=1).reshape(shape), random_state
 
     def __call__(self, sample):
+        if self._fast:
+            return self._call_fast(sample)
+        sample = dict(sample)
+        # deformed in place, input may be a shared view or uint8
+        sample[KEY_LABELS] = np.array(sample[KEY_LABELS], dtype=interpolation_dtype(sample[KEY_LABELS].dtype))
+        if self._apply_to_images and sample[KEY_IMAGES] != []:
+            sample[KEY_IMAGES] = np.array(sample[KEY_IMAGES], dtype=interpolation_dtype(sample[KEY_IMAGES].dtype))
         sample[KEY_LABELS][:, :, :, 0], random_state = self.elastic_transform(sample[KEY_LABELS][:, :, :, 0],
                                                                               self._alpha, self._sigma)
         for c in range(1, sample[KEY_LABELS].shape[3]):
@@ -351,8 +1047,18 @@ class ElasticDeform(object):
         return sample
 
 
+def gaussian_noise_gain(sigma, n_dims=3):
+    """Factor by which gaussian_filter scales the standard deviation of white noise."""
+    impulse = np.zeros(2 * int(4 * sigma + 0.5) + 1)
+    impulse[len(impulse) // 2] = 1
+    return np.linalg.norm(gaussian_filter1d(impulse, sigma)) ** n_dims
+
+
 class ResamplePlaneXY(object):
     """Down- or upsample images."""
+    CACHEABLE = True
+    LAZY = True
+
     def __init__(self, scale_factor=1, mode='nearest'):
         self._scale_factor = scale_factor
         if mode == 'bilinear':
@@ -360,22 +1066,203 @@ class ResamplePlaneXY(object):
         else:
             self._order = 0
 
+    def __repr__(self):
+        return '{}(scale_factor={}, order={})'.format(type(self).__name__, self._scale_factor, self._order)
+
+    def _size_xy(self, shape):
+        return [int(round(size * self._scale_factor)) for size in shape[0:2]]
+
+    def _spacing(self, spacing, shape):
+        """Voxel spacing after resampling a volume of the given shape, i.e. the source step of _zoom_indices."""
+        spacing = np.array(spacing, dtype=np.float64)
+        for dim, size_out in enumerate(self._size_xy(shape)):
+            if size_out > 1:
+                spacing[dim] *= (shape[dim] - 1) / (size_out - 1)
+        return spacing
+
+    def _resample(self, volume):
+        size_xy = self._size_xy(volume.shape)
+        if isinstance(volume, LazyVolume):
+            return ResampledVolume(volume, size_xy, self._order)
+        if self._order == 0:
+            return _interpolate_xy(volume, _zoom_indices(volume.shape[0], size_xy[0]),
+                                   _zoom_indices(volume.shape[1], size_xy[1]))
+        index_x, weight_x = _linear_weights(volume.shape[0], size_xy[0])
+        index_y, weight_y = _linear_weights(volume.shape[1], size_xy[1])
+        return _interpolate_xy(volume, index_x, index_y, weight_x, weight_y)
+
     def __call__(self, sample):
         result = emptyCopyFromSample(sample)
         result[KEY_GLOBAL] = sample[KEY_GLOBAL]
-
         if sample[KEY_IMAGES] != []:
-            sx, sy = ndi.zoom(sample[KEY_IMAGES][:, :, 0], self._scale_factor, order=0).shape[0:2]  # just for init
-            result[KEY_IMAGES] = sample[KEY_IMAGES][:sx, :sy, :, :]  # just for init correctly sized array with random values
-            for c in range(sample[KEY_IMAGES].shape[DIM_CHANNEL_NUMPY_3D]):
-                for z in range(sample[KEY_IMAGES].shape[DIM_DEPTH_NUMPY_3D]):
-                    result[KEY_IMAGES][:, :, z, c] = ndi.zoom(sample[KEY_IMAGES][:, :, z, c], self._scale_factor, order=self._order)
-
+            result[KEY_IMAGES] = self._resample(sample[KEY_IMAGES])
         if sample[KEY_LABELS] != []:
-            sx, sy = ndi.zoom(sample[KEY_LABELS][:, :, 0], self._scale_factor, order=0).shape[0:2]  # just for init
-            result[KEY_LABELS] = sample[KEY_LABELS][:sx, :sy, :, :]  # just for init correctly sized array with random values
-            for c in range(sample[KEY_LABELS].shape[DIM_CHANNEL_NUMPY_3D]):
-                for z in range(sample[KEY_LABELS].shape[DIM_DEPTH_NUMPY_3D]):
-                    result[KEY_LABELS][:, :, z, c] = ndi.zoom(sample[KEY_LABELS][:, :, z, c], self._scale_factor, order=self._order)
+            result[KEY_LABELS] = self._resample(sample[KEY_LABELS])
+        if KEY_SPACING in sample:
+            volume = sample[KEY_LABELS] if sample[KEY_LABELS] != [] else sample[KEY_IMAGES]
+            result[KEY_SPACING] = self._spacing(sample[KEY_SPACING], volume.shape)
+        return result
+
 
-        return result
\ No newline at end of file
+def _interpolate_xy(volume, index_x, index_y, weight_x=None, weight_y=None):
+    """Resamples all slices and channels of a volume XxYxZxC at once from the given
+    source indices, by nearest neighbour or, if weights are given, separable linear
+    interpolation between the source index and its right neighbour.
+    """
+    source = volume.T  # CxZxYxX, C-contiguous for volumes in canonical layout
+    if weight_x is None:
+        # one gather for all slices and channels; its result is made C-contiguous to return the canonical layout
+        return np.ascontiguousarray(source[:, :, index_y[:, np.newaxis], index_x[np.newaxis, :]]).T
+
+    dtype = interpolation_dtype(volume.dtype)
+    rows = source[:, :, :, index_x].astype(dtype, copy=False)
+    rows += (source[:, :, :, index_x + 1] - rows) * weight_x.astype(dtype)
+    output = rows[:, :, index_y]
+    output += (rows[:, :, index_y + 1] - output) * weight_y.astype(dtype)[:, np.newaxis]
+    return np.ascontiguousarray(output, dtype=output_dtype(volume.dtype)).T
+
+
+def _zoom_indices(size_in, size_out):
+    """Nearest neighbour source indices for resampling with aligned corners as in ndi.zoom."""
+    if size_out < 2:
+        return np.zeros(size_out, dtype=np.int64)
+    coordinates = np.arange(size_out) * ((size_in - 1) / (size_out - 1))
+    return np.minimum(np.floor(coordinates + 0.5).astype(np.int64), size_in - 1)
+
+
+def _linear_weights(size_in, size_out):
+    """Left source indices and weights for linear resampling with aligned corners as in ndi.zoom."""
+    if size_out < 2 or size_in < 2:
+        return np.zeros(size_out, dtype=np.int64), np.zeros(size_out)
+    coordinates = np.arange(size_out) * ((size_in - 1) / (size_out - 1))
+    index = np.minimum(np.floor(coordinates).astype(np.int64), size_in - 2)
+    return index, coordinates - index
+
+
+def resample_plane_xy_torch(volumes, scale_factor=1, mode='nearest'):
+    """Down- or upsample a batch of volumes BxCxDxHxW in the HxW plane,
+    consistent with ResamplePlaneXY on the corresponding numpy volumes.
+    Mode 'bilinear' requires floating point tensors.
+    """
+    size_y, size_x = volumes.size()[3:]
+    size_out = (int(round(size_y * scale_factor)), int(round(size_x * scale_factor)))
+    if mode == 'bilinear':
+        return torch.nn.functional.interpolate(volumes, size=(volumes.size()[2],) + size_out, mode='trilinear',
+                                               align_corners=True)
+    index_y = torch.from_numpy(_zoom_indices(size_y, size_out[0])).to(volumes.device)
+    index_x = torch.from_numpy(_zoom_indices(size_x, size_out[1])).to(volumes.device)
+    return volumes.index_select(3, index_y).index_select(4, index_x)
+
+
+def flip_horizontal(volume):
+    """Flips a numpy or lazy volume along X-axis."""
+    if isinstance(volume, LazyVolume):
+        return FlippedVolume(volume)
+    return np.flip(volume, DIM_HORIZONTAL_NUMPY_3D).copy(order='F')
+
+
+class LazyVolume(object):
+    """Volume XxYxZxC whose voxels are only read when a region of it is requested,
+    either by read() with a box of (start, stop) per spatial dimension or by
+    slicing with contiguous slices like a numpy array.
+    """
+    shape = None
+    dtype = None  # dtype of the regions read, None if it is only known from the data
+
+    def read(self, box):
+        raise NotImplementedError()
+
+    def materialize(self):
+        return self.read([(0, size) for size in self.shape[:3]])
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        box = []
+        for dim, size in enumerate(self.shape[:3]):
+            index = key[dim] if dim < len(key) else slice(None)
+            assert isinstance(index, slice) and index.step in (None, 1), 'Lazy volumes only support contiguous slices.'
+            box.append(index.indices(size)[:2])
+        region = self.read(box)
+        if len(key) > DIM_CHANNEL_NUMPY_3D:
+            region = region[:, :, :, key[DIM_CHANNEL_NUMPY_3D]]
+        return region
+
+
+class ProxyVolume(LazyVolume):
+    """Lazy volume of 3D array proxies, e.g. nibabel dataobj or memory-mapped arrays, as channels."""
+    def __init__(self, proxies, dtype=None):
+        self._proxies = proxies
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.shape = tuple(proxies[0].shape[:3]) + (len(proxies),)
+
+    def read(self, box):
+        (x0, x1), (y0, y1), (z0, z1) = box
+        return stack_channels([proxy[x0:x1, y0:y1, z0:z1] for proxy in self._proxies], self.dtype)
+
+
+class FlippedVolume(LazyVolume):
+    """Lazy volume flipped along X-axis."""
+    def __init__(self, volume):
+        self._volume = volume
+        self.shape = volume.shape
+        self.dtype = volume.dtype
+
+    def read(self, box):
+        (x0, x1), box_y, box_z = box
+        size_x = self.shape[DIM_HORIZONTAL_NUMPY_3D]
+        region = self._volume.read([(size_x - x1, size_x - x0), box_y, box_z])
+        return np.flip(region, DIM_HORIZONTAL_NUMPY_3D).copy(order='F')
+
+
+class PaddedVolume(LazyVolume):
+    """Lazy volume padded virtually with constant pad_value as PadImages,
+    only the part of a region inside the original volume is read.
+    """
+    def __init__(self, volume, pad, pad_value=0):
+        self._volume = volume
+        self._pad = pad
+        self._pad_value = pad_value
+        self.shape = tuple(s + 2 * p for s, p in zip(volume.shape[:3], pad)) + volume.shape[3:]
+        self.dtype = output_dtype(volume.dtype) if volume.dtype is not None else np.dtype(np.float32)
+
+    def read(self, box):
+        region = np.full([stop - start for start, stop in box] + [self.shape[DIM_CHANNEL_NUMPY_3D]],
+                         self._pad_value, dtype=self.dtype, order='F')
+        inner = []
+        target = []
+        for (start, stop), pad, size in zip(box, self._pad, self._volume.shape[:3]):
+            inner_start, inner_stop = max(start - pad, 0), min(stop - pad, size)
+            if inner_stop <= inner_start:
+                return region
+            inner.append((inner_start, inner_stop))
+            target.append(slice(inner_start + pad - start, inner_stop + pad - start))
+        region[tuple(target)] = self._volume.read(inner)
+        return region
+
+
+class ResampledVolume(LazyVolume):
+    """Lazy volume resampled in the XY plane as ResamplePlaneXY, only the
+    source region covering the requested output region is read.
+    """
+    def __init__(self, volume, size_xy, order=0):
+        self._volume = volume
+        self._order = order
+        self.shape = tuple(size_xy) + volume.shape[2:]
+        self.dtype = output_dtype(volume.dtype) if volume.dtype is not None else None
+
+    def read(self, box):
+        (x0, x1), (y0, y1), box_z = box
+        size_x, size_y = self._volume.shape[:2]
+        if self._order == 0:
+            index_x = _zoom_indices(size_x, self.shape[0])[x0:x1]
+            index_y = _zoom_indices(size_y, self.shape[1])[y0:y1]
+            weight_x = weight_y = None
+            extent = 1
+        else:
+            index_x, weight_x = [a[x0:x1] for a in _linear_weights(size_x, self.shape[0])]
+            index_y, weight_y = [a[y0:y1] for a in _linear_weights(size_y, self.shape[1])]
+            extent = 2
+        start_x, start_y = index_x.min(), index_y.min()
+        source = self._volume.read([(start_x, index_x.max() + extent), (start_y, index_y.max() + extent), box_z])
+        return _interpolate_xy(source, index_x - start_x, index_y - start_y, weight_x, weight_y)
@@ -3,31 +3,15 @@ from common.dto.Dto import Dto
 
 
 class MeasuresDto(Dto):
-    def add(self, other):
-        if isinstance(other, type(self)):
-            for attr, value in other:
-                if self.__dict__[attr] is None:
-                    self.__dict__[attr] = value
-                elif isinstance(value, MeasuresDto):
-                    self.__dict__[attr].add(value)
-                else:
-                    self.__dict__[attr] += value
-        else:
-            raise Exception('A' + str(type(self)) + 'must be added')
-
-    def div(self, divisor):
-        for attr, value in self:
-            if value is not None and value != numpy.Inf:
-                if isinstance(value, MeasuresDto):
-                    self.__dict__[attr].div(divisor)
-                else:
-                    self.__dict__[attr] = value / divisor
+    """ Base class of DTOs of measures, see MetricAccumulator for averaging them.
+    """
+    pass
 
 
 class BinaryMeasuresDto(MeasuresDto):
     """ DTO for the metric measures on binary images.
     """
-    def __init__(self, dc, hd, assd, precision, sensitivity, specificity):
+    def __init__(self, dc, hd, assd, precision, sensitivity, specificity, hd95=None, msd=None):
         super().__init__()
         self.dc = dc
         self.hd = hd
@@ -35,6 +19,8 @@ class BinaryMeasuresDto(MeasuresDto):
         self.precision = precision
         self.sensitivity = sensitivity  # Recall
         self.specificity = specificity
+        self.hd95 = hd95  # 95th percentile of the surface distances
+        self.msd = msd  # mean surface distance
 
     @property
     def prc_euclidean_distance(self):
@@ -73,3 +59,73 @@ def init_dto(loss=None, core_dc=None, core_hd=None, core_assd=None,
                                lesion_specificity)
 
     return MetricMeasuresDto(loss, core, penu, lesion)
+
+
+class MetricAccumulator(object):
+    """
+    Streaming statistics of MetricMeasuresDto, e.g. of all batches of an epoch. The loss and
+    each (label, measure) are an entry of float64 arrays of the count, mean, M2 (Welford), min
+    and max of the finite values, with separate counts of undefined (None, NaN) and infinite
+    values, so that e.g. one infinite HD does not turn the mean HD into Inf. Each added
+    MetricMeasuresDto is one vectorized update.
+    """
+    LABELS = ['core', 'penu', 'lesion']
+    MEASURES = ['dc', 'hd', 'assd', 'precision', 'sensitivity', 'specificity', 'hd95', 'msd']
+
+    def __init__(self):
+        size = 1 + len(self.LABELS) * len(self.MEASURES)
+        self.count = numpy.zeros(size)
+        self.mean = numpy.zeros(size)
+        self.m2 = numpy.zeros(size)
+        self.min = numpy.full(size, numpy.nan)
+        self.max = numpy.full(size, numpy.nan)
+        self.undefined = numpy.zeros(size)
+        self.infinite = numpy.zeros(size)
+
+    @classmethod
+    def index(cls, label, measure):
+        """Index of a (label, measure) in the arrays, the loss has index 0."""
+        return 1 + cls.LABELS.index(label) * len(cls.MEASURES) + cls.MEASURES.index(measure)
+
+    @classmethod
+    def to_array(cls, dto: MetricMeasuresDto):
+        values = [dto.loss]
+        for label in cls.LABELS:
+            measures = getattr(dto, label, None)
+            values += [getattr(measures, measure, None) for measure in cls.MEASURES]
+        return numpy.array([numpy.nan if value is None else value for value in values], dtype=numpy.float64)
+
+    @classmethod
+    def to_dto(cls, values) -> MetricMeasuresDto:
+        values = [float(value) for value in values]
+        dto = init_dto(values[0])
+        for index, label in enumerate(cls.LABELS):
+            start = 1 + index * len(cls.MEASURES)
+            for measure, value in zip(cls.MEASURES, values[start:start + len(cls.MEASURES)]):
+                setattr(getattr(dto, label), measure, value)
+        return dto
+
+    def add(self, dto: MetricMeasuresDto):
+        values = self.to_array(dto)
+        finite = numpy.isfinite(values)
+        self.undefined += numpy.isnan(values)
+        self.infinite += numpy.isinf(values)
+
+        values = numpy.where(finite, values, self.mean)  # no update of entries without finite value
+        self.count += finite
+        delta = values - self.mean
+        self.mean += delta / numpy.maximum(self.count, 1)
+        self.m2 += delta * (values - self.mean)
+        self.min = numpy.where(finite, numpy.fmin(self.min, values), self.min)
+        self.max = numpy.where(finite, numpy.fmax(self.max, values), self.max)
+
+    def means(self):
+        """Means of the finite values; Inf where all values are infinite, NaN where all are undefined."""
+        return numpy.where(self.count > 0, self.mean, numpy.where(self.infinite > 0, numpy.inf, numpy.nan))
+
+    def std(self):
+        """Sample standard deviations of the finite values, NaN for less than two of them."""
+        return numpy.where(self.count > 1, numpy.sqrt(self.m2 / numpy.maximum(self.count - 1, 1)), numpy.nan)
+
+    def mean_dto(self) -> MetricMeasuresDto:
+        return self.to_dto(self.means())
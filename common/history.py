@@ -0,0 +1,166 @@
+import os
+import json
+import threading
+import numpy
+from common.dto.Dto import Dto
+
+
+def flatten_measures(dto, prefix=''):
+    """Flattens (nested) measure DTOs to {'loss': ..., 'lesion.dc': ...} of floats, None becomes NaN."""
+    values = {}
+    for attr, value in dto:
+        if isinstance(value, Dto):
+            values.update(flatten_measures(value, prefix + attr + '.'))
+        else:
+            values[prefix + attr] = numpy.nan if value is None else float(value)
+    return values
+
+
+class MetricHistory(object):
+    """
+    Append-only history of metric measures per phase (e.g. 'training', 'validate'),
+    kept as one growing numpy column per measure, so that reading a curve or the
+    number of rows does not depend on the length of the training. Written to JSON
+    Lines, one row per line, and markers of the rows that belong to saved training
+    states, which are restored by load to continue a training. Markers have a kind,
+    e.g. the suffix of the saved model, and may be written from another thread, e.g.
+    once the saved state is written.
+    """
+    INITIAL_CAPACITY = 64
+
+    def __init__(self):
+        self._columns = {}  # phase -> {name: numpy array, of which the first length entries are used}
+        self._lengths = {}
+        self._minima = {}  # phase -> {name: minimum over all rows}
+        self._file = None
+        self._lock = threading.Lock()
+        self.saved_kind = ''  # kind and state of the marker restored by load
+        self.saved_state = {}
+
+    def length(self, phase):
+        return self._lengths.get(phase, 0)
+
+    def lengths(self):
+        """Number of rows per phase, e.g. to mark them later."""
+        return dict(self._lengths)
+
+    def column(self, phase, name):
+        """Values of a measure of all rows of the phase, NaN where it was not given."""
+        n = self.length(phase)
+        if name not in self._columns.get(phase, {}):
+            return numpy.full(n, numpy.nan)
+        return self._columns[phase][name][:n]
+
+    def min(self, phase, name='loss'):
+        return self._minima.get(phase, {}).get(name, numpy.Inf)
+
+    def last(self, phase, name='loss'):
+        return self.column(phase, name)[-1]
+
+    def _append_row(self, phase, values):
+        columns = self._columns.setdefault(phase, {})
+        minima = self._minima.setdefault(phase, {})
+        n = self.length(phase)
+        for name, value in values.items():
+            column = columns.get(name)
+            if column is None:
+                column = numpy.full(max(self.INITIAL_CAPACITY, 2 * n), numpy.nan)
+            elif n == len(column):
+                column = numpy.concatenate([column, numpy.full(n, numpy.nan)])
+            column[n] = value
+            columns[name] = column
+            if not numpy.isnan(value):
+                minima[name] = min(minima.get(name, numpy.Inf), value)
+        self._lengths[phase] = n + 1
+
+    def append(self, phase, dto, **index):
+        """
+        Appends the measures of a MeasuresDto as the next row of the phase and writes it.
+        :param index: further values of the row, e.g. epoch or step
+        """
+        values = flatten_measures(dto)
+        values.update(index)
+        self._append_row(phase, values)
+        self._write({'phase': phase, 'values': values})
+
+    def mark(self, lengths=None, kind='', state=None):
+        """
+        Marks rows as belonging to a saved training state.
+        :param lengths: number of rows per phase of the state, see lengths, default the current rows
+        :param kind: kind of the saved state, e.g. '' for an optimum and '_checkpoint' for a checkpoint
+        :param state: further values of the state, e.g. {'step': 1000}, restored as saved_state
+        """
+        self._write(self._marker(self.lengths() if lengths is None else lengths, kind, state))
+
+    @staticmethod
+    def _marker(lengths, kind='', state=None):
+        return {'saved': lengths, 'kind': kind, 'state': state or {}}
+
+    def _write(self, entry):
+        with self._lock:
+            if self._file is not None:
+                self._file.write(json.dumps(entry) + '\n')
+                self._file.flush()
+
+    def _rows(self):
+        for phase, n in self._lengths.items():
+            names = list(self._columns[phase])
+            for i in range(n):
+                values = {name: float(self._columns[phase][name][i]) for name in names}
+                yield {'phase': phase, 'values': {name: value for name, value in values.items()
+                                                  if not numpy.isnan(value)}}
+
+    def open(self, filename):
+        """Writes the history so far to a new file (replacing a previous one), to which further rows are appended."""
+        self.close()
+        tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmp_filename, 'w') as f:
+            for row in self._rows():
+                f.write(json.dumps(row) + '\n')
+            if self._lengths:
+                f.write(json.dumps(self._marker(self.lengths(), self.saved_kind, self.saved_state)) + '\n')
+        os.replace(tmp_filename, filename)
+        with self._lock:
+            self._file = open(filename, 'a')
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    @classmethod
+    def load(cls, filename, kind=None):
+        """
+        Restores the rows of the last saved training state (see mark) from a file written by a history.
+        :param kind: restore the last state of this kind, default the last state of any kind
+        """
+        entries = []
+        saved = cls._marker({})
+        with open(filename, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break  # an interrupted last line
+                if 'saved' not in entry:
+                    entries.append(entry)
+                elif kind is None or entry.get('kind', '') == kind:
+                    saved = entry
+
+        history = cls()
+        history.saved_kind = saved.get('kind', '')
+        history.saved_state = saved.get('state', {})
+        for entry in entries:
+            if history.length(entry['phase']) < saved['saved'].get(entry['phase'], 0):
+                history._append_row(entry['phase'], entry['values'])
+        return history
+
+    @classmethod
+    def from_dtos(cls, metric_dtos):
+        """Converts lists of MeasuresDto per phase, as saved by earlier versions of the Learner."""
+        history = cls()
+        for phase, dtos in metric_dtos.items():
+            for dto in dtos:
+                history._append_row(phase, flatten_measures(dto))
+        return history
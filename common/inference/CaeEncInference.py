@@ -28,6 +28,7 @@ class CaeEncInference(CaeInference):
         return dto
 
     def inference_step(self, batch: dict, step=None):
+        batch = self.prepare_batch(batch)
         dto = self.init_clinical_variables(batch, step)
 
         dto.mode = CaeDtoUtil.FLAG_INPUTS
@@ -63,6 +63,7 @@ class CaeInference(Inference):
         return self._model(dto)
 
     def inference_step(self, batch: dict, step=None):
+        batch = self.prepare_batch(batch)
         dto = self.init_clinical_variables(batch, step)
         dto.mode = CaeDtoUtil.FLAG_GTRUTH
         dto = self.init_gtruth_segm_variables(batch, dto)
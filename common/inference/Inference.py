@@ -1,4 +1,5 @@
 from abc import abstractmethod
+from common import data
 
 
 class Inference():
@@ -19,6 +20,10 @@ class Inference():
     def inference_step(self, batch: dict):
         pass
 
+    def prepare_batch(self, batch: dict) -> dict:
+        """Converts the compact data types of a collated batch to the model dtype, once per batch."""
+        return data.batch_to_dtype(batch, next(self._model.parameters()).dtype)
+
     @property
     def is_cuda(self) -> bool:
         return next(self._model.parameters()).is_cuda
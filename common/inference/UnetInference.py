@@ -13,6 +13,7 @@ class UnetInference(Inference):
         Inference.__init__(self, model)
 
     def inference_step(self, batch):
+        batch = self.prepare_batch(batch)
         input_modalities = Variable(batch[data.KEY_IMAGES])
         core_gt = Variable(batch[data.KEY_LABELS][:, 0, :, :, :].unsqueeze(data.DIM_CHANNEL_TORCH3D_5))
         penu_gt = Variable(batch[data.KEY_LABELS][:, 1, :, :, :].unsqueeze(data.DIM_CHANNEL_TORCH3D_5))
@@ -0,0 +1,132 @@
+import os
+import csv
+import hashlib
+import nibabel as nib
+import numpy as np
+from common.storage import source_stamp
+
+
+def load_clinical_csv(filename, row_offset=1):
+    """Reads the case ids of the first column and the clinical values of the
+    remaining columns of a csv file, skipping row_offset header rows.
+    """
+    rows = []
+    with open(filename, 'r') as f:
+        for row in csv.reader(f, delimiter=','):
+            if row_offset == 0:
+                rows.append(row)
+            else:
+                row_offset -= 1
+    case_ids = np.array([int(row[0]) for row in rows], dtype=np.int64)
+    clinical = np.array([[float(value) for value in row[1:]] for row in rows], dtype=np.float64)
+    return case_ids, clinical.reshape((len(rows), -1))
+
+
+class CaseManifest(object):
+    """Index of a cohort built once at startup: clinical values as numpy array,
+    a dict from case id to row, and per filename suffix the paths, shapes,
+    dtypes and affines of the volumes, read from their NIfTI headers only.
+    With a cache_dir the manifest is stored as .npz, keyed by the modification
+    time and size of the csv file and of all volumes, and loaded from there.
+    """
+    EXT_CACHE = '.npz'
+
+    def __init__(self, arrays, suffixes):
+        self._arrays = arrays
+        self._suffixes = suffixes
+        self.case_ids = arrays['case_ids']
+        self.clinical = arrays['clinical']
+        self.row = {int(case_id): index for index, case_id in enumerate(self.case_ids)}
+
+    @staticmethod
+    def _key(suffix, field):
+        return field + suffix
+
+    @classmethod
+    def build(cls, case_ids, clinical, suffixes, filename):
+        """
+        Reads the headers of all volumes of the given cases and suffixes.
+        :param case_ids: numpy array of case ids
+        :param clinical: numpy array of clinical values, one row per case
+        :param suffixes: filename suffixes of modalities and labels
+        :param filename: function (case_id, suffix) -> path of the volume
+        :return: CaseManifest
+        """
+        arrays = {'case_ids': case_ids, 'clinical': clinical}
+        for suffix in suffixes:
+            paths = [filename(int(case_id), suffix) for case_id in case_ids]
+            shapes = np.zeros((len(paths), 3), dtype=np.int64)
+            dtypes = [''] * len(paths)
+            affines = np.full((len(paths), 4, 4), np.nan)
+            for index, path in enumerate(paths):
+                if os.path.exists(path):
+                    img = nib.load(path)  # header only, voxels are not decoded
+                    shapes[index] = img.shape[:3]
+                    dtypes[index] = img.get_data_dtype().str
+                    affines[index] = img.affine
+            arrays[cls._key(suffix, 'path')] = np.array(paths, dtype=str)
+            arrays[cls._key(suffix, 'shape')] = shapes
+            arrays[cls._key(suffix, 'dtype')] = np.array(dtypes, dtype=str)
+            arrays[cls._key(suffix, 'affine')] = affines
+        return cls(arrays, suffixes)
+
+    @classmethod
+    def get(cls, clinical_csv, suffixes, filename, row_offset=1, cache_dir=None):
+        """Loads the manifest from cache_dir if it is still valid, otherwise builds (and stores) it."""
+        case_ids, clinical = load_clinical_csv(clinical_csv, row_offset)
+        if cache_dir is None:
+            return cls.build(case_ids, clinical, suffixes, filename)
+
+        stamps = [clinical_csv, source_stamp(clinical_csv)] + list(suffixes)
+        for case_id in case_ids:
+            for suffix in suffixes:
+                path = filename(int(case_id), suffix)
+                stamps += [path, source_stamp(path) if os.path.exists(path) else 'missing']
+        key = hashlib.sha1(','.join(stamps).encode()).hexdigest()[:16]
+        manifest_fn = os.path.join(cache_dir, 'manifest', key + cls.EXT_CACHE)
+        if os.path.exists(manifest_fn):
+            return cls.load(manifest_fn, suffixes)
+
+        manifest = cls.build(case_ids, clinical, suffixes, filename)
+        manifest.save(manifest_fn)
+        return manifest
+
+    def save(self, filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            np.savez(f, **self._arrays)
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename, suffixes):
+        with np.load(filename) as npz:
+            arrays = {key: npz[key] for key in npz.files}
+        return cls(arrays, suffixes)
+
+    def _get(self, case_id, suffix, field):
+        return self._arrays[self._key(suffix, field)][self.row[case_id]]
+
+    def path(self, case_id, suffix):
+        return str(self._get(case_id, suffix, 'path'))
+
+    def shape(self, case_id, suffix):
+        return tuple(int(size) for size in self._get(case_id, suffix, 'shape'))
+
+    def dtype(self, case_id, suffix):
+        return np.dtype(str(self._get(case_id, suffix, 'dtype')))
+
+    def affine(self, case_id, suffix):
+        return self._get(case_id, suffix, 'affine')
+
+    def spacing(self, case_id, suffix):
+        """Voxel sizes along the axes of the volume, from its affine."""
+        return np.sqrt(np.sum(self.affine(case_id, suffix)[:3, :3] ** 2, axis=0))
+
+    def exists(self, case_id, suffix):
+        return bool(self._get(case_id, suffix, 'dtype'))
+
+    def missing(self, case_ids):
+        """Paths of the volumes of the given cases that do not exist."""
+        return [self.path(case_id, suffix) for case_id in case_ids for suffix in self._suffixes
+                if not self.exists(case_id, suffix)]
@@ -1,8 +1,13 @@
 import numpy
+import multiprocessing
 import medpy.metric.binary as mpm
+from concurrent.futures import Future
+from scipy.ndimage import binary_erosion, distance_transform_edt, generate_binary_structure
 from common.dto.MetricMeasuresDto import BinaryMeasuresDto
+from common.data import bounding_box
 from torch.nn.modules.loss import _Loss as LossModule
 from torch.autograd import Variable
+import torch
 
 
 class BatchDiceLoss(LossModule):
@@ -28,7 +33,60 @@ class BatchDiceLoss(LossModule):
         return 1.0 - loss
 
 
-def binary_measures_numpy(result, target, binary_threshold=0.5):
+class SurfaceDistances(object):
+    """
+    Distances between the surface voxels of two (non-empty) binary masks, from each
+    surface to the nearest surface voxel of the other one, as defined by medpy.metric.binary.
+    Both masks are cropped to their joint bounding box (plus margin) and each distance
+    transform is computed once, from which all surface distance measures are derived.
+    :param voxelspacing: spacing per axis, e.g. in mm, or for the trailing axes only
+    """
+    def __init__(self, result, reference, voxelspacing=None, connectivity=1, margin=1):
+        result = numpy.atleast_1d(result.astype(numpy.bool_))
+        reference = numpy.atleast_1d(reference.astype(numpy.bool_))
+        assert result.any() and reference.any(), 'Surface distances require non-empty masks'
+        if voxelspacing is not None:
+            voxelspacing = numpy.asarray(voxelspacing, dtype=numpy.float64).reshape(-1)
+            if len(voxelspacing) == 1:
+                voxelspacing = numpy.repeat(voxelspacing, result.ndim)
+            voxelspacing = numpy.concatenate([numpy.ones(result.ndim - len(voxelspacing)), voxelspacing])
+
+        # The surfaces, and thus the nearest surface voxels, lie within the joint bounding box. A margin of
+        # at least one voxel keeps the erosion at the crop boundary as it is on the full volume.
+        bbox = bounding_box(result | reference, margin=max(1, margin))
+        crop = tuple(slice(start, stop) for start, stop, _ in bbox)
+        result = result[crop]
+        reference = reference[crop]
+
+        footprint = generate_binary_structure(result.ndim, connectivity)
+        result_border = result ^ binary_erosion(result, structure=footprint, iterations=1)
+        reference_border = reference ^ binary_erosion(reference, structure=footprint, iterations=1)
+
+        self.result_to_reference = distance_transform_edt(~reference_border, sampling=voxelspacing)[result_border]
+        self.reference_to_result = distance_transform_edt(~result_border, sampling=voxelspacing)[reference_border]
+
+    @property
+    def hd(self):
+        """Hausdorff distance"""
+        return max(self.result_to_reference.max(), self.reference_to_result.max())
+
+    @property
+    def hd95(self):
+        """95th percentile of the distances of both directions"""
+        return numpy.percentile(numpy.hstack((self.result_to_reference, self.reference_to_result)), 95)
+
+    @property
+    def assd(self):
+        """Average symmetric surface distance, i.e. the mean of the average distances of both directions (medpy 0.3)"""
+        return numpy.mean((self.result_to_reference.mean(), self.reference_to_result.mean()))
+
+    @property
+    def msd(self):
+        """Mean surface distance, i.e. the mean of the distances of both directions together (assd of medpy >= 0.4)"""
+        return numpy.hstack((self.result_to_reference, self.reference_to_result)).mean()
+
+
+def binary_measures_numpy(result, target, binary_threshold=0.5, voxelspacing=None):
     result_binary = (result > binary_threshold).astype(numpy.uint8)
     target_binary = (target > binary_threshold).astype(numpy.uint8)
 
@@ -37,16 +95,21 @@ def binary_measures_numpy(result, target, binary_threshold=0.5):
                                numpy.Inf,
                                mpm.precision(result_binary, target_binary),
                                mpm.sensitivity(result_binary, target_binary),
-                               mpm.specificity(result_binary, target_binary))
+                               mpm.specificity(result_binary, target_binary),
+                               hd95=numpy.Inf,
+                               msd=numpy.Inf)
 
     if result_binary.any() and target_binary.any():
-        result.hd = mpm.hd(result_binary, target_binary)
-        result.assd = mpm.assd(result_binary, target_binary)
+        distances = SurfaceDistances(result_binary, target_binary, voxelspacing)
+        result.hd = distances.hd
+        result.hd95 = distances.hd95
+        result.assd = distances.assd
+        result.msd = distances.msd
 
     return result
 
 
-def binary_measures_torch(result, target, cuda, binary_threshold=0.5):
+def binary_measures_torch(result, target, cuda, binary_threshold=0.5, voxelspacing=None):
     if cuda:
         result = result.cpu()
         target = target.cpu()
@@ -59,4 +122,186 @@ def binary_measures_torch(result, target, cuda, binary_threshold=0.5):
     result = result.numpy()
     target = target.numpy()
 
-    return binary_measures_numpy(result, target, binary_threshold=binary_threshold)
\ No newline at end of file
+    return binary_measures_numpy(result, target, binary_threshold=binary_threshold, voxelspacing=voxelspacing)
+
+def _ratio(numerator, denominator, undefined=0.0):
+    return numpy.where(denominator > 0, numerator / numpy.maximum(denominator, 1), undefined)
+
+
+def confusion_counts(results, targets, binary_threshold=0.5):
+    """
+    Counts of true/false positives/negatives of (B, L, ...) tensors, computed in one reduction on their device.
+    :return: numpy arrays tp, fp, fn, tn of shape (B, L), i.e. per sample and label
+    """
+    batch_size, n_labels = results.size(0), results.size(1)
+    results = (results > binary_threshold).float().view(batch_size, n_labels, -1)
+    targets = (targets > binary_threshold).float().view(batch_size, n_labels, -1)
+    sums = torch.stack([results * targets, results, targets]).sum(3).cpu().numpy().astype(numpy.float64)
+    tp = sums[0]
+    fp = sums[1] - tp
+    fn = sums[2] - tp
+    tn = results.size(2) - tp - fp - fn
+    return tp, fp, fn, tn
+
+
+def _label_tensor(tensors):
+    """Concatenates (B, 1, ...) tensors or Variables, one per label, to a (B, L, ...) tensor."""
+    return torch.cat([tensor.data if isinstance(tensor, Variable) else tensor for tensor in tensors], 1)
+
+
+def binary_masks(results, targets, binary_threshold=0.5):
+    """Thresholded (B, L, ...) numpy masks on the CPU, of lists of (B, 1, ...) tensors or Variables per label."""
+    return ((_label_tensor(results) > binary_threshold).cpu().numpy(),
+            (_label_tensor(targets) > binary_threshold).cpu().numpy())
+
+
+def surface_distance_measures(measures, result_masks, target_masks, voxelspacing=None):
+    """
+    Sets the surface distances of a BinaryMeasuresDto per label, averaged over the samples
+    for which they are defined, i.e. with non-empty masks, and Inf if there is none.
+    :param measures: list of BinaryMeasuresDto, one per label
+    :param result_masks: (B, L, ...) numpy mask, see binary_masks
+    :param target_masks: (B, L, ...) numpy mask, see binary_masks
+    :param voxelspacing: spacing of the spatial axes, e.g. in mm, or (B, n) spacings per sample (see
+                         data.batch_spacing), default voxel units
+    :return: measures
+    """
+    spacings = [voxelspacing] * len(result_masks)
+    if voxelspacing is not None and numpy.ndim(voxelspacing) == 2:
+        spacings = list(voxelspacing)
+    for label, label_measures in enumerate(measures):
+        sample_distances = [SurfaceDistances(result_masks[sample, label], target_masks[sample, label],
+                                             spacings[sample])
+                            for sample in range(len(result_masks))
+                            if result_masks[sample, label].any() and target_masks[sample, label].any()]
+        for measure in ['hd', 'hd95', 'assd', 'msd']:
+            values = [getattr(distance, measure) for distance in sample_distances]
+            setattr(label_measures, measure, numpy.mean(values) if values else numpy.Inf)
+    return measures
+
+
+def binary_measures_batch(results, targets, binary_threshold=0.5, distances=True, voxelspacing=None):
+    """
+    Measures of several labels (e.g. core, penumbra and lesion) per sample, averaged over the samples.
+    Dice, precision, sensitivity and specificity are computed from the confusion counts of all labels
+    and samples on the device of the tensors (dice of two empty masks is 1, other undefined ratios 0).
+    Only for the surface distances the thresholded masks are moved to the CPU, see surface_distance_measures.
+    :param results: list of (B, 1, ...) tensors or Variables, one per label
+    :param targets: list of (B, 1, ...) tensors or Variables, one per label
+    :param distances: whether to compute the surface distances, else they are NaN
+    :param voxelspacing: spacing for the surface distances, see surface_distance_measures
+    :return: list of BinaryMeasuresDto, one per label
+    """
+    results = _label_tensor(results)
+    targets = _label_tensor(targets)
+
+    tp, fp, fn, tn = confusion_counts(results, targets, binary_threshold)
+    dc = _ratio(2 * tp, 2 * tp + fp + fn, undefined=1.0).mean(0)
+    precision = _ratio(tp, tp + fp).mean(0)
+    sensitivity = _ratio(tp, tp + fn).mean(0)
+    specificity = _ratio(tn, tn + fp).mean(0)
+
+    measures = [BinaryMeasuresDto(dc[label], numpy.nan, numpy.nan, precision[label], sensitivity[label],
+                                  specificity[label], hd95=numpy.nan, msd=numpy.nan)
+                for label in range(results.size(1))]
+    if distances:
+        surface_distance_measures(measures, (results > binary_threshold).cpu().numpy(),
+                                  (targets > binary_threshold).cpu().numpy(), voxelspacing)
+    return measures
+
+
+def threshold_curves(result, target, n_thresholds=100, binary_threshold=0.5):
+    """
+    Confusion counts and measures of a probability map for the thresholds k / n_thresholds, k = 0..n-1,
+    i.e. voxels with probability > threshold are positive, in one pass: each voxel is binned by the
+    number of thresholds it exceeds and the counts follow from cumulative sums of the bin counts of
+    target and background voxels. Precision and sensitivity give the PR curve, 1 - specificity and
+    sensitivity the ROC curve.
+    :param result: tensor, Variable or numpy array of probabilities
+    :param target: tensor, Variable or numpy array, binarized with binary_threshold
+    :return: dict of numpy arrays of length n_thresholds: threshold, tp, fp, fn, tn, dc, precision,
+             sensitivity and specificity
+    """
+    if isinstance(result, Variable):
+        result = result.data
+    if isinstance(target, Variable):
+        target = target.data
+    if torch.is_tensor(result):
+        result = result.cpu().numpy()
+    if torch.is_tensor(target):
+        target = target.cpu().numpy()
+    target = target.ravel() > binary_threshold
+    result = result.ravel()
+    # number of thresholds strictly below p, compared in the dtype of the result as result > threshold would
+    thresholds = numpy.arange(n_thresholds) / n_thresholds
+    bins = numpy.searchsorted(thresholds.astype(result.dtype), result, side='left')
+
+    # number of voxels exceeding threshold k, i.e. of voxels in bins > k
+    tp = numpy.cumsum(numpy.bincount(bins[target], minlength=n_thresholds + 1)[::-1])[::-1][1:].astype(numpy.float64)
+    fp = numpy.cumsum(numpy.bincount(bins[~target], minlength=n_thresholds + 1)[::-1])[::-1][1:].astype(numpy.float64)
+    fn = numpy.count_nonzero(target) - tp
+    tn = numpy.count_nonzero(~target) - fp
+    return {'threshold': thresholds,
+            'tp': tp, 'fp': fp, 'fn': fn, 'tn': tn,
+            'dc': _ratio(2 * tp, 2 * tp + fp + fn, undefined=1.0),
+            'precision': _ratio(tp, tp + fp),
+            'sensitivity': _ratio(tp, tp + fn),
+            'specificity': _ratio(tn, tn + fp)}
+
+
+def _add_surface_distances(batch_metrics, names, result_masks, target_masks, voxelspacing):
+    surface_distance_measures([getattr(batch_metrics, name) for name in names], result_masks, target_masks,
+                              voxelspacing)
+    return batch_metrics
+
+
+class MetricsService(object):
+    """
+    Computes the surface distances of batch metrics in worker processes, so that training
+    continues meanwhile; submit returns futures, which are gathered e.g. at the end of an
+    epoch. The (costly) surface distances can be restricted to every distance_every epochs
+    and to validation; otherwise they are NaN.
+    :param processes: number of worker processes, 0 computes synchronously
+    :param distance_every: interval of epochs with surface distances
+    :param distance_training: whether to compute surface distances of training batches, too
+    """
+    def __init__(self, processes=0, distance_every=1, distance_training=True):
+        self._processes = processes
+        self._distance_every = distance_every
+        self._distance_training = distance_training
+        self._pool = None
+
+    def distances_due(self, epoch, training):
+        return epoch % self._distance_every == 0 and (self._distance_training or not training)
+
+    def submit(self, batch_metrics, names, results, targets, voxelspacing=None):
+        """
+        Future of batch_metrics with the surface distances of the labels.
+        :param batch_metrics: MetricMeasuresDto, of which the attributes names are set
+        :param names: attribute names of the labels, e.g. ['core', 'penu']
+        :param results: list of (B, 1, ...) tensors or Variables, one per label
+        :param targets: list of (B, 1, ...) tensors or Variables, one per label
+        :param voxelspacing: spacing for the surface distances, see surface_distance_measures
+        """
+        future = Future()
+        args = (batch_metrics, list(names)) + binary_masks(results, targets) + (voxelspacing,)
+        if self._processes == 0:
+            future.set_result(_add_surface_distances(*args))
+            return future
+        if self._pool is None:
+            # spawn, since the training process may hold CUDA contexts and threads
+            self._pool = multiprocessing.get_context('spawn').Pool(self._processes)
+        self._pool.apply_async(_add_surface_distances, args, callback=future.set_result,
+                               error_callback=future.set_exception)
+        return future
+
+    @staticmethod
+    def gather(items):
+        """Results of futures, other items (e.g. metrics without surface distances) as they are."""
+        return [item.result() if isinstance(item, Future) else item for item in items]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
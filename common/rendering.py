@@ -0,0 +1,132 @@
+import threading
+import time
+import multiprocessing
+
+
+def _init_process():
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def save_plot(filename, curves, ylabel, ylim=None, twin_curves=(), twin_ylabel=None, twin_color='b', dpi=300):
+    """
+    Plots curves over 1..n, e.g. metrics per epoch, and saves the figure.
+    :param curves: list of (values, format) on the left y axis
+    :param ylabel: label of the left y axis
+    :param ylim: (min, max) of the left y axis
+    :param twin_curves: list of (values, format) on a right y axis
+    :param twin_ylabel: label of the right y axis, shown in twin_color
+    """
+    import matplotlib.pyplot as plt
+    fig, plot = plt.subplots()
+    for values, fmt in curves:
+        plot.plot(range(1, len(values) + 1), values, fmt)
+    plot.set_ylabel(ylabel)
+    if ylim is not None:
+        plot.set_ylim(*ylim)
+    if twin_curves:
+        ax2 = plot.twinx()
+        for values, fmt in twin_curves:
+            ax2.plot(range(1, len(values) + 1), values, fmt)
+        ax2.set_ylabel(twin_ylabel, color=twin_color)
+        ax2.tick_params('y', colors=twin_color)
+    fig.savefig(filename, bbox_inches='tight', dpi=dpi)
+    plt.close(fig)
+
+
+def save_image_grid(filename, rows, titles, dpi=300):
+    """
+    Shows 2D images in a grid with small titles and without axes, and saves the figure.
+    :param rows: list of rows, each a list of (image, vmin, vmax, cmap)
+    :param titles: list of rows, each a list of titles
+    """
+    import matplotlib.pyplot as plt
+    f, axarr = plt.subplots(len(rows), len(rows[0]), squeeze=False)
+    for axes, row, row_titles in zip(axarr, rows, titles):
+        for ax, (image, vmin, vmax, cmap), title in zip(axes, row, row_titles):
+            ax.imshow(image, vmin=vmin, vmax=vmax, cmap=cmap)
+            ax.set_title(title)
+
+    for ax in axarr.flatten():
+        ax.title.set_fontsize(3)
+        ax.xaxis.set_visible(False)
+        ax.yaxis.set_visible(False)
+
+    f.subplots_adjust(hspace=0.05)
+    f.savefig(filename, bbox_inches='tight', dpi=dpi)
+    plt.close(f)
+
+
+class Renderer(object):
+    """Renders plots and visualizations, i.e. module level functions of detached numpy
+    data such as save_plot and save_image_grid, in a background process. Requests of
+    the same kind are rate-limited to one per min_interval seconds and coalesced, i.e.
+    only the latest waiting request of a kind is rendered. With processes=0 requests
+    are rendered immediately in the calling thread.
+    """
+    def __init__(self, min_interval=0, processes=1):
+        self._min_interval = min_interval
+        self._processes = processes
+        self._pool = None
+        self._condition = threading.Condition()
+        self._pending = {}  # kind -> latest (function, args, kwargs) not yet started
+        self._running = set()
+        self._started = {}  # kind -> time the last request of this kind was started
+        self._timers = {}
+
+    def submit(self, kind, function, *args, **kwargs):
+        if self._processes == 0:
+            function(*args, **kwargs)
+            return
+        with self._condition:
+            self._pending[kind] = (function, args, kwargs)
+            self._schedule(kind)
+
+    def _schedule(self, kind):
+        if kind in self._running or kind not in self._pending or kind in self._timers:
+            return
+        wait = self._started.get(kind, 0) + self._min_interval - time.time()
+        if wait > 0:
+            timer = threading.Timer(wait, self._on_timer, (kind,))
+            timer.daemon = True
+            self._timers[kind] = timer
+            timer.start()
+            return
+
+        if self._pool is None:
+            # spawn, since the training process may hold CUDA contexts and threads
+            self._pool = multiprocessing.get_context('spawn').Pool(self._processes, initializer=_init_process)
+        function, args, kwargs = self._pending.pop(kind)
+        self._running.add(kind)
+        self._started[kind] = time.time()
+        self._pool.apply_async(function, args, kwargs, callback=lambda _: self._on_done(kind),
+                               error_callback=lambda error: self._on_done(kind, error))
+
+    def _on_timer(self, kind):
+        with self._condition:
+            self._timers.pop(kind, None)
+            self._schedule(kind)
+
+    def _on_done(self, kind, error=None):
+        if error is not None:
+            print('Rendering', kind, 'failed:', error)
+        with self._condition:
+            self._running.discard(kind)
+            self._schedule(kind)
+            self._condition.notify_all()
+
+    def close(self):
+        """Renders all waiting requests without rate limit and waits for the background process to finish."""
+        with self._condition:
+            for timer in self._timers.values():
+                timer.cancel()
+            self._timers = {}
+            self._min_interval = 0
+            for kind in list(self._pending):
+                self._schedule(kind)
+            while self._pending or self._running:
+                self._condition.wait()
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
@@ -0,0 +1,161 @@
+import os
+import shutil
+import hashlib
+import numpy as np
+
+
+def source_stamp(filename):
+    """Identifies the current version of a source file by its modification time and size."""
+    stat = os.stat(filename)
+    return '{}-{}'.format(stat.st_mtime_ns, stat.st_size)
+
+
+def files_stamp(filenames):
+    """Identifies the current version of a set of source files by a short hash of their stamps."""
+    stamps = ','.join(source_stamp(filename) for filename in filenames)
+    return hashlib.sha1(stamps.encode()).hexdigest()[:16]
+
+
+def compact_volume(volume, is_label=False):
+    """Converts a decoded volume to float32, or to uint8 for label masks if this is lossless."""
+    if is_label:
+        compact = volume.astype(np.uint8)
+        if np.array_equal(compact, volume):
+            return compact
+    return volume.astype(np.float32)
+
+
+class PackedMask(object):
+    """Binary mask volume packed to 1 bit per voxel with np.packbits, in Fortran
+    order so that unpacking restores the canonical layout of the data pipeline.
+    """
+    def __init__(self, bits, shape):
+        self.bits = bits
+        self.shape = tuple(shape)
+
+    @staticmethod
+    def is_packable(volume):
+        return volume.dtype in (np.uint8, np.bool_) and (volume.size == 0 or volume.max() <= 1)
+
+    @classmethod
+    def pack(cls, volume):
+        return cls(np.packbits(volume.ravel(order='F')), volume.shape)
+
+    def unpack(self):
+        n_voxels = int(np.prod(self.shape))
+        return np.unpackbits(self.bits)[:n_voxels].reshape(self.shape, order='F')
+
+
+def save_atomic(filename, array):
+    """Writes an array as .npy to a temporary file and renames it, so
+    concurrent readers never see a partially written file.
+    """
+    tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_filename, filename)
+
+
+class VolumeCache(object):
+    """On-disk cache of decoded volumes as uncompressed .npy files.
+    Entries are keyed by case id, suffix and the modification time
+    and size of the source file; stale entries of a case and suffix
+    are removed as soon as the source file has changed.
+    """
+    EXT_CACHE = '.npy'
+
+    def __init__(self, cache_dir):
+        self._cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _case_dir(self, case_id):
+        return os.path.join(self._cache_dir, str(case_id))
+
+    def _fn(self, case_id, suffix, stamp):
+        return os.path.join(self._case_dir(case_id), suffix + '.' + stamp + self.EXT_CACHE)
+
+    def _invalidate(self, case_id, suffix, stamp):
+        """Removes the entries of older stamps; the current one may just have been stored by another worker."""
+        current = os.path.basename(self._fn(case_id, suffix, stamp))
+        for fn in os.listdir(self._case_dir(case_id)):
+            if fn.endswith(self.EXT_CACHE) and fn.rsplit('.', 2)[0] == suffix and fn != current:
+                try:
+                    os.remove(os.path.join(self._case_dir(case_id), fn))
+                except FileNotFoundError:
+                    pass  # removed concurrently by another worker
+
+    def load(self, case_id, suffix, source, decode):
+        """
+        Loads a volume from cache, or decodes and stores it if there is no valid entry.
+        :param case_id: case id of the volume
+        :param suffix:  filename suffix of the volume (modality or label)
+        :param source:  filename of the source file the entry is derived from
+        :param decode:  function that decodes the source file into a numpy array
+        :return: read-only memory-mapped numpy array
+        """
+        stamp = source_stamp(source)
+        filename = self._fn(case_id, suffix, stamp)
+        if not os.path.exists(filename):
+            os.makedirs(self._case_dir(case_id), exist_ok=True)
+            self._invalidate(case_id, suffix, stamp)
+            save_atomic(filename, decode(source))
+        return np.load(filename, mmap_mode='r')
+
+
+class SampleCache(object):
+    """Cache of preprocessed samples, i.e. dicts of numpy arrays per case.
+    Samples are kept in memory, or stored as .npy files in a directory
+    per case and stamp and loaded memory-mapped if a cache_dir is given.
+    An entry is replaced as soon as the stamp of its case changes.
+    """
+    EXT_CACHE = '.npy'
+    EXT_TMP = '.tmp'
+
+    def __init__(self, cache_dir=None):
+        self._cache_dir = cache_dir
+        self._samples = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _dir(self, case_id, stamp):
+        return os.path.join(self._cache_dir, str(case_id) + '.' + stamp)
+
+    def _invalidate(self, case_id, stamp):
+        """Removes the entries of older stamps; the current one may just have been stored by another worker."""
+        current = os.path.basename(self._dir(case_id, stamp))
+        for fn in os.listdir(self._cache_dir):
+            if fn.split('.', 1)[0] == str(case_id) and not fn.endswith(self.EXT_TMP) and fn != current:
+                shutil.rmtree(os.path.join(self._cache_dir, fn), ignore_errors=True)
+
+    def _store(self, path, sample):
+        tmp_path = '{}.{}{}'.format(path, os.getpid(), self.EXT_TMP)
+        os.makedirs(tmp_path)
+        for key, value in sample.items():
+            np.save(os.path.join(tmp_path, key + self.EXT_CACHE), value)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)  # stored concurrently by another worker
+
+    def _load(self, path):
+        return {fn[:-len(self.EXT_CACHE)]: np.load(os.path.join(path, fn), mmap_mode='r')
+                for fn in os.listdir(path) if fn.endswith(self.EXT_CACHE)}
+
+    def get(self, case_id, stamp, compute):
+        """
+        Returns the cached sample of a case, or computes and stores it if there is no valid entry.
+        :param case_id: case id of the sample
+        :param stamp:   identifies the version of the source data the sample is derived from
+        :param compute: function without arguments that returns the sample as dict of numpy arrays
+        :return: dict of numpy arrays, which are read-only if memory-mapped
+        """
+        if self._cache_dir is None:
+            if case_id not in self._samples or self._samples[case_id][0] != stamp:
+                self._samples[case_id] = (stamp, compute())
+            return self._samples[case_id][1]
+
+        path = self._dir(case_id, stamp)
+        if not os.path.isdir(path):
+            self._invalidate(case_id, stamp)
+            self._store(path, compute())
+        return self._load(path)
@@ -1,5 +1,6 @@
 import argparse
-from common import data
+import time
+from common import data, metrics
 
 
 # ======================= DETERMINISTIC DATA ===========================
@@ -11,6 +12,8 @@ def get_vis_samples(train_loader, valid_loader):
     visual_times = []
     for i in train_loader.sampler.indices:
         sample = train_loader.dataset[i]
+        if isinstance(sample, list):  # patches of a case, see data.PatchesPerCase
+            sample = sample[0]
         sample[data.KEY_IMAGES] = sample[data.KEY_IMAGES].unsqueeze(0)
         sample[data.KEY_LABELS] = sample[data.KEY_LABELS].unsqueeze(0)
         sample[data.KEY_GLOBAL] = sample[data.KEY_GLOBAL].unsqueeze(0)
@@ -22,6 +25,8 @@ def get_vis_samples(train_loader, valid_loader):
     if valid_loader is not None:
         for i in valid_loader.sampler.indices:
             sample = valid_loader.dataset[i]
+            if isinstance(sample, list):  # patches of a case, see data.PatchesPerCase
+                sample = sample[0]
             sample[data.KEY_IMAGES] = sample[data.KEY_IMAGES].unsqueeze(0)
             sample[data.KEY_LABELS] = sample[data.KEY_LABELS].unsqueeze(0)
             sample[data.KEY_GLOBAL] = sample[data.KEY_GLOBAL].unsqueeze(0)
@@ -34,6 +39,51 @@ def get_vis_samples(train_loader, valid_loader):
     return visual_samples, visual_times
 
 
+# ============================ TRAINING SCHEDULE =======================
+
+
+class Interval(object):
+    """Interval of training steps, e.g. '200', or of seconds, e.g. '300s'. Never due if 0."""
+    def __init__(self, value='0'):
+        value = str(value)
+        self.seconds = value.endswith('s')
+        self.value = float(value[:-1]) if self.seconds else int(value)
+        self.start()
+
+    def __repr__(self):
+        return '{}({}{})'.format(type(self).__name__, self.value, 's' if self.seconds else '')
+
+    def start(self, step=0):
+        self._last_step = step
+        self._last_time = time.time()
+
+    def due(self, step):
+        """Whether the interval has passed since the last time it was due, and restarts it if so."""
+        if self.value <= 0:
+            return False
+        if self.seconds:
+            is_due = time.time() - self._last_time >= self.value
+        else:
+            is_due = step - self._last_step >= self.value
+        if is_due:
+            self.start(step)
+        return is_due
+
+
+def run_training(learner, args):
+    """Runs epoch-based training, or step-based training if --steps is given."""
+    if args.steps > 0:
+        learner.run_training_steps(args.steps, args.validateevery, args.checkpointevery, args.plotevery,
+                                   args.visualizeevery)
+    else:
+        learner.run_training()
+
+
+def get_metrics_service(args):
+    """Service computing the surface distances of the batch metrics of a learner, as configured by args."""
+    return metrics.MetricsService(args.metricprocesses, args.distanceevery, not args.validationdistances)
+
+
 # =================================== PARSER ===========================
 
 
@@ -51,6 +101,43 @@ class ExpParser(argparse.ArgumentParser):
         self.add_argument('--zsize', type=int, help='Number of z slices', default=28)
         self.add_argument('--padding', type=int, nargs='+', help='Padding of patches', default=[20, 20, 20])
         self.add_argument('--lrsteps', type=int, nargs='+', help='MultiStepLR epochs', default=[])
+        self.add_argument('--cachedir', type=str, help='Directory for caching decoded volumes', default=None)
+        self.add_argument('--transformcache', type=str, choices=['memory', 'disk'], default=None,
+                          help='Cache the output of the deterministic leading transforms per case')
+        self.add_argument('--workers', type=int, help='Number of data loading worker processes', default=0)
+        self.add_argument('--prefetchfactor', type=int, help='Batches loaded in advance by each worker', default=2)
+        self.add_argument('--persistentworkers', action='store_true', default=False,
+                          help='Keep data loading workers alive across epochs')
+        self.add_argument('--pinmemory', action='store_true', help='Load batches into pinned memory', default=False)
+        self.add_argument('--resident', action='store_true', default=False,
+                          help='Keep all cases in shared memory for the data loading workers')
+        self.add_argument('--lazy', action='store_true', default=False,
+                          help='Read only the required regions of uncompressed volumes, see convert_volumes.py')
+        self.add_argument('--decodethreads', type=int, help='Threads decoding the files of a case', default=1)
+        self.add_argument('--readahead', type=int, default=0,
+                          help='Cases loaded ahead in sampler order, only without data loading workers')
+        self.add_argument('--imagedtype', type=str, choices=['float16', 'float32'], default='float32',
+                          help='Data type of images in the data pipeline')
+        self.add_argument('--packlabels', action='store_true', default=False,
+                          help='Store and transfer binary labels bit-packed, unpacked per batch')
+        self.add_argument('--residentvalidation', action='store_true', default=False,
+                          help='Load and transform the validation batches once and keep them in memory')
+        self.add_argument('--steps', type=int, default=0,
+                          help='Train for a number of steps on an endless sampler instead of epochs')
+        self.add_argument('--validateevery', type=Interval, default=Interval('50'),
+                          help='Validation interval of step-based training, in steps or seconds (e.g. 300s)')
+        self.add_argument('--checkpointevery', type=Interval, default=Interval('0'),
+                          help='Checkpoint interval of step-based training, in steps or seconds, 0 for none')
+        self.add_argument('--plotevery', type=Interval, default=Interval('300s'),
+                          help='Plot interval of step-based training, in steps or seconds, 0 for none')
+        self.add_argument('--visualizeevery', type=Interval, default=Interval('1800s'),
+                          help='Visualization interval of step-based training, in steps or seconds, 0 for none')
+        self.add_argument('--metricprocesses', type=int, default=0,
+                          help='Processes computing surface distance metrics while training continues, 0 for none')
+        self.add_argument('--distanceevery', type=int, default=1,
+                          help='Compute surface distance metrics (e.g. HD, ASSD) every n epochs only')
+        self.add_argument('--validationdistances', action='store_true', default=False,
+                          help='Compute surface distance metrics of validation batches only')
 
     def parse_args(self, args=None, namespace=None):
         args = super().parse_args(args, namespace)
@@ -68,6 +155,10 @@ class CAEParser(ExpParser):
         self.add_argument('--inbasepath', type=str, help='Path and filename base for loading', default=None)
         self.add_argument('--outbasepath', type=str, help='Path and filename base for saving', default='/tmp/tmp_out')
         self.add_argument('--steplearning', action='store_true', help='Also learn interpolation step from clinical data', default=False)
+        self.add_argument('--fastelastic', action='store_true', help='Elastic deformation on coarse displacement grids',
+                          default=False)
+        self.add_argument('--batchaugment', action='store_true', help='Augment collated training batches in torch',
+                          default=False)
 
 
 class UnetParser(ExpParser):
@@ -80,6 +171,14 @@ class UnetParser(ExpParser):
         self.add_argument('--epochs', type=int, help='Number of epochs', default=200)
         self.add_argument('--outbasepath', type=str, help='Path and filename base for outputs',
                           default='/share/data_zoe1/lucas/Linda_Segmentations/tmp/unet')
+        self.add_argument('--patchespercase', type=int, default=1,
+                          help='Training patches drawn from each loaded case, batches are built from these patches')
+        self.add_argument('--foregroundratio', type=float, default=0.0,
+                          help='Fraction of training patches drawn around a random core or penumbra voxel')
+        self.add_argument('--bboxcrop', action='store_true', default=False,
+                          help='Crop test cases to the brain bounding box, paste outputs back for metrics and save')
+        self.add_argument('--thresholds', type=int, default=0,
+                          help='Testing: write Dice/PR/ROC curves over this number of thresholds per case')
 
 
 class SDMParser(ExpParser):
@@ -135,6 +234,25 @@ def get_args_shape_testing():
                         default='/share/data_zoe1/lucas/Linda_Segmentations/tmp/shape')
     parser.add_argument('--xyresample', type=int, help='Factor for resampling slices', default=0.5)
     parser.add_argument('--padding', type=int, nargs='+', help='Padding of patches', default=[20, 20, 20])
+    parser.add_argument('--cachedir', type=str, help='Directory for caching decoded volumes', default=None)
+    parser.add_argument('--transformcache', type=str, choices=['memory', 'disk'], default=None,
+                        help='Cache the output of the deterministic leading transforms per case')
+    parser.add_argument('--workers', type=int, help='Number of data loading worker processes', default=4)
+    parser.add_argument('--decodethreads', type=int, help='Threads decoding the files of a case', default=1)
+    parser.add_argument('--readahead', type=int, default=0,
+                        help='Cases loaded ahead in sampler order, only without data loading workers')
+    parser.add_argument('--thresholds', type=int, default=0,
+                        help='Write Dice/PR/ROC curves over this number of thresholds per case')
+    args = parser.parse_args()
+    return args
+
+
+def get_args_volume_conversion():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rootdir', type=str, help='Root directory of the case directories',
+                        default=data.StrokeLindaDataset3D.PATH_ROOT)
+    parser.add_argument('--modalities', type=str, nargs='+', help='Filename suffixes of images', default=[])
+    parser.add_argument('--labels', type=str, nargs='+', help='Filename suffixes of label masks', default=[])
     args = parser.parse_args()
     return args
 
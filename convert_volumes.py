@@ -0,0 +1,36 @@
+import os
+import datetime
+import nibabel as nib
+from common import data, util
+from common.storage import compact_volume
+
+
+def convert(root_dir, modalities, labels):
+    """Writes every compressed volume of the given suffixes as uncompressed NIfTI next to it,
+    as float32 (images) or uint8 (label masks), for lazy reading of regions only.
+    """
+    dataset = data.StrokeLindaDataset3D
+    case_ids = sorted(int(fn) for fn in os.listdir(root_dir) if fn.isdigit())
+    for case_id in case_ids:
+        for suffix in modalities + labels:
+            src = os.path.join(root_dir, dataset.FN_PATTERN.format(dataset.FN_PREFIX, case_id, suffix))
+            dst = os.path.join(root_dir, dataset.FN_PATTERN_UNCOMPRESSED.format(dataset.FN_PREFIX, case_id, suffix))
+            if not os.path.exists(src):
+                print('Skipping missing', src)
+                continue
+            img = nib.load(src)
+            volume = compact_volume(img.get_data(), suffix in labels)
+            header = img.header.copy()
+            header.set_data_dtype(volume.dtype)
+            header.set_slope_inter(1, 0)
+            tmp_dst = '{}.{}.tmp.nii'.format(dst[:-len('.nii')], os.getpid())
+            nib.save(nib.Nifti1Image(volume, img.affine, header), tmp_dst)
+            os.replace(tmp_dst, dst)
+        print('Converted case', case_id)
+
+
+if __name__ == '__main__':
+    print(datetime.datetime.now())
+    args = util.get_args_volume_conversion()
+    convert(args.rootdir, args.modalities, args.labels)
+    print(datetime.datetime.now())
@@ -3,11 +3,8 @@ matplotlib.use('Agg')
 from learner.Learner import Learner
 from common.dto.CaeDto import CaeDto
 from common.inference.CaeInference import CaeInference
-import common.dto.MetricMeasuresDto as MetricMeasuresDtoInit
-import matplotlib.pyplot as plt
 import torch
-from common import data, util, metrics
-import numpy
+from common import data
 
 
 class CaeReconstructionLearner(Learner, CaeInference):
@@ -19,9 +16,11 @@ class CaeReconstructionLearner(Learner, CaeInference):
     N_EPOCHS_ADAPT_BETA1 = 4
 
     def __init__(self, dataloader_training, dataloader_validation, cae_model, optimizer, scheduler, n_epochs,
-                 path_previous_base, path_outputs_base, criterion, normalization_hours_penumbra=10):
+                 path_previous_base, path_outputs_base, criterion, normalization_hours_penumbra=10,
+                 batch_transform=None, resident_validation=False, metrics_service=None):
         Learner.__init__(self, dataloader_training, dataloader_validation, cae_model, optimizer, scheduler, n_epochs,
-                         path_previous_base, path_outputs_base)
+                         path_previous_base, path_outputs_base, batch_transform, resident_validation,
+                         metrics_service)
         CaeInference.__init__(self, cae_model, normalization_hours_penumbra)  # TODO: refactor double initialization?!
         self._criterion = criterion  # main loss criterion
 
@@ -40,14 +39,10 @@ class CaeReconstructionLearner(Learner, CaeInference):
             print('Momentum betas have been set to:', param_group['betas'], end=' ')
 
     def get_start_epoch(self):
-        if self._metric_dtos['training']:
-            return len([dto.loss for dto in self._metric_dtos['training']])
-        return 0
+        return self._history.length('training')
 
     def get_start_min_loss(self):
-        if self._metric_dtos['validate']:
-            return min([dto.loss for dto in self._metric_dtos['validate']])
-        return numpy.Inf
+        return self._history.min('validate', 'loss')
 
     def loss_step(self, dto: CaeDto, epoch):
         factor = min(0.04 * max(0, epoch - 25), 1)
@@ -69,15 +64,10 @@ class CaeReconstructionLearner(Learner, CaeInference):
 
         return loss / divd
 
-    def batch_metrics_step(self, dto: CaeDto, epoch):
-        batch_metrics = MetricMeasuresDtoInit.init_dto()
-        batch_metrics.lesion = metrics.binary_measures_torch(dto.reconstructions.gtruth.interpolation,
-                                                             dto.given_variables.gtruth.lesion, self.is_cuda)
-        batch_metrics.core = metrics.binary_measures_torch(dto.reconstructions.gtruth.core,
-                                                           dto.given_variables.gtruth.core, self.is_cuda)
-        batch_metrics.penu = metrics.binary_measures_torch(dto.reconstructions.gtruth.penu,
-                                                           dto.given_variables.gtruth.penu, self.is_cuda)
-        return batch_metrics
+    def metric_labels(self, dto: CaeDto):
+        return [('lesion', dto.reconstructions.gtruth.interpolation, dto.given_variables.gtruth.lesion),
+                ('core', dto.reconstructions.gtruth.core, dto.given_variables.gtruth.core),
+                ('penu', dto.reconstructions.gtruth.penu, dto.given_variables.gtruth.penu)]
 
     def print_epoch(self, epoch, phase, epoch_metrics):
         output = '\nEpoch {}/{} {} loss: {:.3} - DC:{:.3}, HD:{:.3}, ASSD:{:.3}, DC core:{:.3}, DC penu.:{:.3}'
@@ -89,67 +79,44 @@ class CaeReconstructionLearner(Learner, CaeInference):
                             epoch_metrics.core.dc,
                             epoch_metrics.penu.dc), end=' ')
 
-    def plot_epoch(self, plot, epochs):
-        plot.plot(epochs, [dto.loss for dto in self._metric_dtos['training']], 'r-')
-        plot.plot(epochs, [dto.loss for dto in self._metric_dtos['validate']], 'g-')
-        plot.plot(epochs, [dto.lesion.dc for dto in self._metric_dtos['validate']], 'k-')
-        plot.plot(epochs, [dto.core.dc for dto in self._metric_dtos['validate']], 'c+')
-        plot.plot(epochs, [dto.penu.dc for dto in self._metric_dtos['validate']], 'm+')
-        plot.set_ylabel('L Train.(red)/Val.(green) | Dice Val. Lesion(b), Core(c), Penu(m)')
-        plot.set_ylim(0, 1)
-        ax2 = plot.twinx()
-        ax2.plot(epochs, [dto.lesion.assd for dto in self._metric_dtos['validate']], 'b-')
-        ax2.set_ylabel('Validation ASSD (blue)', color='b')
-        ax2.tick_params('y', colors='b')
+    def plot_epoch(self):
+        return {'curves': [(self._history.column('training', 'loss'), 'r-'),
+                           (self._history.column('validate', 'loss'), 'g-'),
+                           (self._history.column('validate', 'lesion.dc'), 'k-'),
+                           (self._history.column('validate', 'core.dc'), 'c+'),
+                           (self._history.column('validate', 'penu.dc'), 'm+')],
+                'ylabel': 'L Train.(red)/Val.(green) | Dice Val. Lesion(b), Core(c), Penu(m)',
+                'ylim': (0, 1),
+                'twin_curves': [(self._history.column('validate', 'lesion.assd'), 'b-')],
+                'twin_ylabel': 'Validation ASSD (blue)'}
 
     def visualize_epoch(self, epoch):
-        visual_samples, visual_times = util.get_vis_samples(self._dataloader_training, self._dataloader_validation)
+        visual_samples, visual_times = self.visual_samples()
 
-        f, axarr = plt.subplots(len(visual_samples), 15)
-        inc = 0
+        rows = []
+        titles = []
         for sample, time in zip(visual_samples, visual_times):
 
-            col = 3
+            predictions = []
             for step in [None, -10, -1, 0, 1, 2, 3, 4, 5, 20]:
                 dto = self.inference_step(sample, step)
-                axarr[inc, col].imshow(dto.reconstructions.gtruth.interpolation.cpu().data.numpy()[0, 0, 14, :, :],
-                                       vmin=0, vmax=1, cmap='gray')
-                if col == 3:
-                    col += 1
-                col += 1
-
-            axarr[inc, 0].imshow(sample[data.KEY_IMAGES].numpy()[0, 0, 14, :, :],
-                                 vmin=0, vmax=self.IMSHOW_VMAX_CBV, cmap='jet')
-            axarr[inc, 1].imshow(sample[data.KEY_IMAGES].numpy()[0, 1, 14, :, :],
-                                 vmin=0, vmax=self.IMSHOW_VMAX_TTD, cmap='jet')
-            axarr[inc, 2].imshow(dto.given_variables.gtruth.lesion.cpu().data.numpy()[0, 0, 14, :, :],
-                                 vmin=0, vmax=1, cmap='gray')
-            axarr[inc, 4].imshow(dto.given_variables.gtruth.core.cpu().data.numpy()[0, 0, 14, :, :],
-                                 vmin=0, vmax=1, cmap='gray')
-            axarr[inc, 14].imshow(dto.given_variables.gtruth.penu.cpu().data.numpy()[0, 0, 14, :, :],
-                                  vmin=0, vmax=1, cmap='gray')
-
-            del sample
-            del dto
-
-            titles = ['CBV', 'TTD', 'Lesion', 'p(' +
-                      ('{:03.1f}'.format(float(time)))
-                      + 'h)', 'Core', 'p(-10h)', 'p(-1h)', 'p(0h)', 'p(1h)', 'p(2h)', 'p(3h)', 'p(4h)', 'p(5h)',
-                      'p(20h)',
-                      'Penumbra']
+                predictions.append((dto.reconstructions.gtruth.interpolation.cpu().data.numpy()[0, 0, 14, :, :],
+                                    0, 1, 'gray'))
 
-            for ax, title in zip(axarr[inc], titles):
-                ax.set_title(title)
+            rows.append([(sample[data.KEY_IMAGES].numpy()[0, 0, 14, :, :], 0, self.IMSHOW_VMAX_CBV, 'jet'),
+                         (sample[data.KEY_IMAGES].numpy()[0, 1, 14, :, :], 0, self.IMSHOW_VMAX_TTD, 'jet'),
+                         (dto.given_variables.gtruth.lesion.cpu().data.numpy()[0, 0, 14, :, :], 0, 1, 'gray'),
+                         predictions[0],
+                         (dto.given_variables.gtruth.core.cpu().data.numpy()[0, 0, 14, :, :], 0, 1, 'gray')] +
+                        predictions[1:] +
+                        [(dto.given_variables.gtruth.penu.cpu().data.numpy()[0, 0, 14, :, :], 0, 1, 'gray')])
 
-            inc += 1
-
-        for ax in axarr.flatten():
-            ax.title.set_fontsize(3)
-            ax.xaxis.set_visible(False)
-            ax.yaxis.set_visible(False)
+            del dto
 
-        f.subplots_adjust(hspace=0.05)
-        f.savefig(self._path_outputs_base + self.FN_VIS_BASE + str(epoch + 1) + '.png', bbox_inches='tight', dpi=300)
+            titles.append(['CBV', 'TTD', 'Lesion', 'p(' +
+                           ('{:03.1f}'.format(float(time)))
+                           + 'h)', 'Core', 'p(-10h)', 'p(-1h)', 'p(0h)', 'p(1h)', 'p(2h)', 'p(3h)', 'p(4h)', 'p(5h)',
+                           'p(20h)',
+                           'Penumbra'])
 
-        del f
-        del axarr
+        self.save_visualization(epoch, rows, titles)
@@ -1,16 +1,19 @@
 from abc import abstractmethod
 from torch.utils.data import DataLoader
 from common.dto.Dto import Dto
+from common import data, util, rendering, checkpoint, metrics
+from common.history import MetricHistory
 from common.inference.Inference import Inference
 from common.dto.MetricMeasuresDto import MetricMeasuresDto
 import common.dto.MetricMeasuresDto as MetricMeasuresDtoInit
 from torch.optim.optimizer import Optimizer
 from torch.optim.lr_scheduler import _LRScheduler
 from torch.nn import Module
-import matplotlib.pyplot as plt
 import torch
 import numpy
+import random
 import jsonpickle
+import os
 
 
 class Learner(Inference):
@@ -27,12 +30,17 @@ class Learner(Inference):
     FNB_MARKS = '_learner'   # filename base for specific learner
     EXT_MODEL = '.model'     # filename extension for model data
     EXT_OPTIM = '.optim'     # filename extension for optimizer state dict
-    EXT_TRAIN = '.json'      # filename extension for training data
+    EXT_TRAIN = '.jsonl'     # filename extension for training data
     EXT_IMAGE = '.png'       # filename extension for any image data
+    SEED_VALIDATION = 0      # seed for random transforms of a resident validation set
+    RENDER_INTERVAL = 60     # minimum seconds between renderings of plots (or visualizations)
+    KEEP_BEST = 3            # number of retained models of the last optima ('_best' suffix)
+    KEEP_CHECKPOINTS = 3     # number of retained checkpoints of step-based training ('_checkpoint' suffix)
 
     def __init__(self, dataloader_training: DataLoader, dataloader_validation: DataLoader, model: Module,
                  optimizer: Optimizer, scheduler: _LRScheduler, n_epochs: int, path_previous_base: str = None,
-                 path_outputs_base: str = '/tmp/stroke-prediction'):
+                 path_outputs_base: str = '/tmp/stroke-prediction', batch_transform=None,
+                 resident_validation=False, metrics_service: metrics.MetricsService = None):
         # init inference
         Inference.__init__(self, model)
 
@@ -43,18 +51,26 @@ class Learner(Inference):
         self._optimizer = optimizer
         self._scheduler = scheduler
         self._n_epochs = n_epochs
+        self._batch_transform = batch_transform  # batched augmentation of collated training batches
+        self._resident_validation = resident_validation
+        self._validation_batches = None  # collated validation batches, if resident
+        self._metrics_service = metrics_service or metrics.MetricsService()  # surface distances of batch metrics
+        self._visual_samples = None
+        self._renderer = rendering.Renderer(self.RENDER_INTERVAL)
+        self._checkpoints = checkpoint.CheckpointWriter()
 
         self._path_outputs_base = path_outputs_base
         self._path_previous_base = path_previous_base
 
         # load previous training data to continue
         if path_previous_base is not None:
-            self.load_model(self.is_cuda)
             self.load_training()            # restore training curves from previous training
+            self.load_model(self.is_cuda, self._history.saved_kind)  # model of the last saved training state
             print('Continue training', path_previous_base, '...')
         else:
-            self._metric_dtos = {'training': [], 'validate': []}
-        assert len(self._metric_dtos['training']) == len(self._metric_dtos['validate']), 'Incomplete training data!'
+            self._history = MetricHistory()
+        assert self._history.length('training') == self._history.length('validate'), 'Incomplete training data!'
+        self._history.open(self.path('save', self.FNB_TRAIN))
 
     def path(self, mode: str, type: str, suffix: str=''):
         if mode == 'load':
@@ -87,33 +103,93 @@ class Learner(Inference):
     def get_start_min_loss(self):
         return numpy.Inf
 
-    def load_model(self, cuda=True):
-        path_model = self.path('load', self.FNB_MODEL)
+    def get_start_step(self):
+        """Step of the continued training state (see save_checkpoint and save_optimum), 0 for a new training."""
+        if 'step' in self._history.saved_state:
+            return self._history.saved_state['step']
+        if self._history.length('training') == 0 or numpy.isnan(self._history.last('training', 'step')):
+            return 0
+        return int(self._history.last('training', 'step'))  # an optimum, saved right after a validation
+
+    def load_model(self, cuda=True, suffix=''):
+        path_model = self.path('load', self.FNB_MODEL, suffix)
         if cuda:
             self._model = torch.load(path_model).cuda()
         else:
             self._model = torch.load(path_model)
 
     def load_training(self):
+        """Restores the metrics history and the optimizer state of the last saved training state, of any kind."""
         path_training = self.path('load', self.FNB_TRAIN)
-        path_optimizer = self.path('load', self.FNB_OPTIM)
+        if os.path.exists(path_training):
+            self._history = MetricHistory.load(path_training)
+        else:  # jsonpickle'd lists of MetricMeasuresDto of earlier trainings
+            with open(self._path_previous_base + self.FNB_MARKS + '.json', 'r') as fp:
+                self._history = MetricHistory.from_dtos(jsonpickle.decode(fp.read()))
+        path_optimizer = self.path('load', self.FNB_OPTIM, self._history.saved_kind)
         print('Loading:', path_training, path_optimizer)
         self._optimizer.load_state_dict(torch.load(path_optimizer))
-        with open(path_training, 'r') as fp:
-            self._metric_dtos = jsonpickle.decode(fp.read())
-
-    def save_training(self):
-        path_training = self.path('save', self.FNB_TRAIN)
-        path_optimizer = self.path('save', self.FNB_OPTIM)
-        torch.save(self._optimizer.state_dict(), path_optimizer)
-        with open(path_training, 'w') as fp:
-            fp.write(jsonpickle.encode(self._metric_dtos))
-
-    def save_model(self, suffix=''):
-        torch.save(self._model.cpu(), self.path('save', self.FNB_MODEL, suffix))
-        self._model.cuda()
 
-    def train_batch(self, batch: dict, epoch) -> MetricMeasuresDto:
+    def save_training(self, kind='', state=None):
+        """
+        Saves the optimizer state of the kind and, once it and the models submitted before are written,
+        marks the metrics history so far as saved (see MetricHistory.mark).
+        :param kind: suffix of the saved model and optimizer state, e.g. '_checkpoint'
+        :param state: further values to continue the training, e.g. {'step': 1000}
+        """
+        self._checkpoints.save_state(self._optimizer.state_dict(), self.path('save', self.FNB_OPTIM, kind))
+        self._checkpoints.commit(self._history.mark, self._history.lengths(), kind, state)
+
+    def save_model(self, suffix='', aliases=()):
+        """Saves the model in the background, also under the suffixes in aliases."""
+        self._checkpoints.save_module(self._model, self.path('save', self.FNB_MODEL, suffix),
+                                      [self.path('save', self.FNB_MODEL, alias) for alias in aliases])
+
+    def model_paths(self, suffix=''):
+        """All files written by save_model for the suffix."""
+        return [self.path('save', self.FNB_MODEL, suffix)]
+
+    def save_optimum(self, index, loss):
+        """Saves model and training of a new optimum and retains the models of the last KEEP_BEST optima."""
+        suffix = '_best' + str(index)
+        self.save_model('', [suffix])
+        self._checkpoints.retain(self.FNB_MODEL + '_best', self.model_paths(suffix), self.KEEP_BEST, loss)
+        self.save_training()  # allows to continue if training has been interrupted
+
+    def save_checkpoint(self, step):
+        """Saves model and training ('_checkpoint' suffix), retaining the models of the last KEEP_CHECKPOINTS."""
+        suffix = '_checkpoint' + str(step)
+        self.save_model('_checkpoint', [suffix])
+        self._checkpoints.retain(self.FNB_MODEL + '_checkpoint', self.model_paths(suffix), self.KEEP_CHECKPOINTS)
+        self.save_training('_checkpoint', {'step': step})
+
+    def build_validation_batches(self):
+        """Collates all validation batches once and keeps them in memory, so that
+        every epoch validates on the same (e.g. patches) data without reloading it.
+        Random transforms of the validation set are seeded with SEED_VALIDATION.
+        """
+        states = random.getstate(), numpy.random.get_state(), torch.get_rng_state()
+        random.seed(self.SEED_VALIDATION)
+        numpy.random.seed(self.SEED_VALIDATION)
+        torch.manual_seed(self.SEED_VALIDATION)  # sampler order and seeds of loader workers
+        self._validation_batches = [batch for batch in self._dataloader_validation]
+        random.setstate(states[0])
+        numpy.random.set_state(states[1])
+        torch.set_rng_state(states[2])
+
+    def validation_batches(self):
+        if self._validation_batches is not None:
+            return self._validation_batches
+        return self._dataloader_validation
+
+    def prepare_training_batch(self, batch: dict) -> dict:
+        batch = data.unpack_batch(batch)
+        if self._batch_transform is not None:
+            batch = self._batch_transform(batch)
+        return batch
+
+    def train_batch(self, batch: dict, epoch):
+        """Trains on the batch and returns its metrics, or a future of them, see distance_metrics_step."""
         dto = self.inference_step(batch)
         loss = self.loss_step(dto, epoch)
 
@@ -122,47 +198,111 @@ class Learner(Inference):
         self._optimizer.step()
 
         batch_metrics = self.batch_metrics_step(dto, epoch)
-        batch_metrics.loss = loss.squeeze().cpu().data.numpy()[0]
+        batch_metrics.loss = loss.item()
+        batch_metrics = self.distance_metrics_step(batch_metrics, dto, epoch, data.batch_spacing(batch))
 
         del loss
         del dto
 
         return batch_metrics
 
-    def validate_batch(self, batch: dict, epoch) -> MetricMeasuresDto:
+    def validate_batch(self, batch: dict, epoch):
+        """Metrics of the batch, or a future of them, see distance_metrics_step."""
         dto = self.inference_step(batch)
         loss = self.loss_step(dto, epoch)
 
         batch_metrics = self.batch_metrics_step(dto, epoch)
-        batch_metrics.loss = loss.squeeze().cpu().data.numpy()[0]
+        batch_metrics.loss = loss.item()
+        batch_metrics = self.distance_metrics_step(batch_metrics, dto, epoch, data.batch_spacing(batch))
 
         del loss
         del dto
 
         return batch_metrics
 
+    def metric_labels(self, dto: Dto):
+        """(name, output, ground truth) of the labels measured by batch_metrics_step, name as in MetricMeasuresDto."""
+        return []
+
     def batch_metrics_step(self, dto: Dto, epoch) -> MetricMeasuresDto:
-        return MetricMeasuresDtoInit.init_dto()
+        """Measures of the metric_labels from confusion counts, without surface distances."""
+        batch_metrics = MetricMeasuresDtoInit.init_dto()
+        labels = self.metric_labels(dto)
+        if labels:
+            names, results, targets = zip(*labels)
+            for name, measures in zip(names, metrics.binary_measures_batch(results, targets, distances=False)):
+                setattr(batch_metrics, name, measures)
+        return batch_metrics
+
+    def distance_metrics_step(self, batch_metrics: MetricMeasuresDto, dto: Dto, epoch, voxelspacing=None):
+        """Future of the batch_metrics with the surface distances of the metric_labels, computed by the
+        metrics service, or the batch_metrics as they are if no distances are due in this epoch and phase.
+        Distances are in units of the voxelspacing per sample (see data.batch_spacing), else in voxels.
+        """
+        labels = self.metric_labels(dto)
+        if not labels or not self._metrics_service.distances_due(epoch, self._model.training):
+            return batch_metrics
+        names, results, targets = zip(*labels)
+        return self._metrics_service.submit(batch_metrics, names, results, targets, voxelspacing)
+
+    def average_metrics(self, batch_metrics: list) -> MetricMeasuresDto:
+        """Waits for the metrics of all batches (see distance_metrics_step) and averages them, see MetricAccumulator."""
+        accumulator = MetricMeasuresDtoInit.MetricAccumulator()
+        for measures in self._metrics_service.gather(batch_metrics):
+            accumulator.add(measures)
+        return accumulator.mean_dto()
 
     def print_epoch(self, epoch, phase, epoch_metrics: MetricMeasuresDto):
         pass
 
-    def plot_epoch(self, plotter, epochs):
-        pass
+    def plot_epoch(self):
+        """Keyword arguments of rendering.save_plot for the metrics history, or None."""
+        return None
+
+    def visual_samples(self):
+        """Samples and times to visualize, fetched once by util.get_vis_samples."""
+        if self._visual_samples is None:
+            self._visual_samples = util.get_vis_samples(self._dataloader_training, self._dataloader_validation)
+        return self._visual_samples
 
     def visualize_epoch(self, epoch):
         pass
 
+    def save_visualization(self, epoch, rows, titles):
+        """Renders a grid of images in the background, see rendering.save_image_grid."""
+        filename = self._path_outputs_base + self.FN_VIS_BASE + str(epoch + 1) + self.EXT_IMAGE
+        self._renderer.submit(self.FNB_IMAGE, rendering.save_image_grid, filename, rows, titles)
+
     def adapt_lr(self, epoch):
         if self._scheduler is not None:
-            self._scheduler.step()
+            self._scheduler.step(epoch)  # the epoch, not the number of calls, also when a training is continued
 
     def adapt_betas(self, epoch):
         pass
 
+    def validate(self, epoch) -> MetricMeasuresDto:
+        """Metrics averaged over all validation batches, zeros without validation data."""
+        self._model.eval()
+
+        if self._dataloader_validation is None:
+            return MetricMeasuresDtoInit.init_dto(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+
+        return self.average_metrics([self.validate_batch(batch, epoch) for batch in self.validation_batches()])
+
+    def save_plots(self):
+        """Renders the plot of the metrics history in the background."""
+        plot = self.plot_epoch()
+        if plot is not None:
+            filename = self._path_outputs_base + self.FN_VIS_BASE + self.FNB_PLOTS + self.EXT_IMAGE
+            self._renderer.submit(self.FNB_PLOTS, rendering.save_plot, filename, **plot)
+
     def run_training(self):
         min_loss = self.get_start_min_loss()
 
+        if self._resident_validation and self._dataloader_validation is not None:
+            self.build_validation_batches()
+        self.visual_samples()
+
         for epoch in range(self.get_start_epoch(), self._n_epochs):
             self.adapt_lr(epoch)
             self.adapt_betas(epoch)
@@ -171,40 +311,29 @@ class Learner(Inference):
 
             self._model.train()
 
-            epoch_metrics = MetricMeasuresDtoInit.init_dto()
+            batch_metrics = []  # metrics (or futures) of all batches, gathered once the epoch has been trained
             for batch in self._dataloader_training:
-                epoch_metrics.add(self.train_batch(batch, epoch))
-            epoch_metrics.div(len(self._dataloader_training))
+                batch_metrics.append(self.train_batch(self.prepare_training_batch(batch), epoch))
+            epoch_metrics = self.average_metrics(batch_metrics)
             del batch
 
             self.print_epoch(epoch, 'training', epoch_metrics)
-            self._metric_dtos['training'].append(epoch_metrics)
+            self._history.append('training', epoch_metrics, epoch=epoch + 1)
             del epoch_metrics
 
             # ---------------------------- (2) VALIDATE ---------------------------- #
 
-            self._model.eval()
-
-            if self._dataloader_validation is None:
-                epoch_metrics = MetricMeasuresDtoInit.init_dto(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0,
-                                                               0.0, 0.0)
-            else:
-                epoch_metrics = MetricMeasuresDtoInit.init_dto()
-                for batch in self._dataloader_validation:
-                    epoch_metrics.add(self.validate_batch(batch, epoch))
-                epoch_metrics.div(len(self._dataloader_validation))
-                del batch
+            epoch_metrics = self.validate(epoch)
 
             self.print_epoch(epoch, 'validate', epoch_metrics)
-            self._metric_dtos['validate'].append(epoch_metrics)
+            self._history.append('validate', epoch_metrics, epoch=epoch + 1)
             del epoch_metrics
 
             # ------------ (3) SAVE MODEL / VISUALIZE (if new optimum) ------------ #
 
-            if self._metric_dtos['validate'] and self._metric_dtos['validate'][-1].loss < min_loss:
-                min_loss = self._metric_dtos['validate'][-1].loss
-                self.save_model()
-                self.save_training()  # allows to continue if training has been interrupted
+            if self._history.last('validate') < min_loss:
+                min_loss = self._history.last('validate')
+                self.save_optimum(epoch + 1, min_loss)
                 print('(New optimum: Training saved)', end=' ')
                 self.visualize_epoch(epoch)
 
@@ -214,13 +343,101 @@ class Learner(Inference):
             # ----------------- (4) PLOT / SAVE EVALUATION METRICS ---------------- #
 
             if epoch > 0:
-                fig, plot = plt.subplots()
-                self.plot_epoch(plot, range(1, epoch + 2))
-                fig.savefig(self._path_outputs_base + self.FN_VIS_BASE + 'plots.png', bbox_inches='tight', dpi=300)
-                del plot
-                del fig
+                self.save_plots()
 
         # ------------ (5) SAVE FINAL MODEL / VISUALIZE ------------- #
 
         self.save_model('_final')
         self.visualize_epoch(epoch)
+        self._renderer.close()
+        self._checkpoints.wait()
+        self._history.close()
+        self._metrics_service.close()
+
+    def _endless_training_batches(self):
+        while True:  # a data.InfiniteSampler keeps the loader (and its workers) running instead
+            for batch in self._dataloader_training:
+                yield batch
+
+    def run_training_steps(self, n_steps, validate_every, checkpoint_every=None, plot_every=None,
+                           visualize_every=None):
+        """
+        Step-based training, preferably on a data loader with data.InfiniteSampler.
+        Validation (saving model and training at a new optimum), checkpoints, plots
+        and visualizations run at separate intervals of steps or seconds, so that
+        bookkeeping does not follow the (few) batches of an epoch.
+        :param n_steps: number of training steps, i.e. optimizer updates
+        :param validate_every: util.Interval of validation; the training metrics are averaged in between
+        :param checkpoint_every: util.Interval of saving model and training, see save_checkpoint
+        :param plot_every: util.Interval of plotting the metrics of all validations so far
+        :param visualize_every: util.Interval of sample visualizations
+        """
+        start_step = self.get_start_step()
+        intervals = [interval or util.Interval() for interval in [validate_every, checkpoint_every, plot_every,
+                                                                   visualize_every]]
+        validate_every, checkpoint_every, plot_every, visualize_every = intervals
+        for interval in intervals:
+            interval.start(start_step)
+
+        min_loss = self.get_start_min_loss()
+
+        if self._resident_validation and self._dataloader_validation is not None:
+            self.build_validation_batches()
+        self.visual_samples()
+
+        steps_per_epoch = len(self._dataloader_training)
+        self._n_epochs = -(-n_steps // steps_per_epoch)  # passes over the training data, for print_epoch
+        batches = self._endless_training_batches()
+        batch_metrics = []
+        epoch = None
+
+        self._model.train()
+
+        for step in range(start_step + 1, n_steps + 1):
+            if epoch != (step - 1) // steps_per_epoch:
+                epoch = (step - 1) // steps_per_epoch
+                self.adapt_lr(epoch)
+                self.adapt_betas(epoch)
+
+            batch_metrics.append(self.train_batch(self.prepare_training_batch(next(batches)), epoch))
+
+            # ----------------- VALIDATE (SAVE MODEL IF NEW OPTIMUM) ----------------- #
+
+            if validate_every.due(step) or step == n_steps:
+                print('\nStep {}/{}'.format(step, n_steps), end='')
+                training_metrics = self.average_metrics(batch_metrics)
+                self.print_epoch(epoch, 'training', training_metrics)
+                self._history.append('training', training_metrics, epoch=epoch + 1, step=step)
+                batch_metrics = []
+
+                validation_metrics = self.validate(epoch)
+                self.print_epoch(epoch, 'validate', validation_metrics)
+                self._history.append('validate', validation_metrics, epoch=epoch + 1, step=step)
+
+                if validation_metrics.loss < min_loss:
+                    min_loss = validation_metrics.loss
+                    self.save_optimum(step, min_loss)
+                    print('(New optimum: Training saved)', end=' ')
+                del validation_metrics
+
+            # --------------------- CHECKPOINT / PLOT / VISUALIZE --------------------- #
+
+            if checkpoint_every.due(step):
+                self.save_checkpoint(step)
+
+            if plot_every.due(step) and self._history.length('validate') > 1:
+                self.save_plots()
+
+            if visualize_every.due(step):
+                self._model.eval()
+                self.visualize_epoch(epoch)
+
+            self._model.train()
+
+        self.save_model('_final')
+        self._model.eval()
+        self.visualize_epoch((n_steps - 1) // steps_per_epoch)  # also if continued at the last step
+        self._renderer.close()
+        self._checkpoints.wait()
+        self._history.close()
+        self._metrics_service.close()
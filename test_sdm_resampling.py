@@ -78,7 +78,9 @@ def infer():
                                 labels=['_CBVmap_subset_reg1_downsampled', '_TTDmap_subset_reg1_downsampled',
                                         '_FUCT_MAP_T_Samplespace_subset_reg1_downsampled'],
                                 transform=transform,
-                                indices=args.fold)
+                                indices=args.fold,
+                                cache_dir=args.cachedir, transform_cache=args.transformcache,
+                                decode_threads=args.decodethreads)
 
     # Unet
     #unet = None  TODO Unet live segmentation
@@ -88,6 +90,7 @@ def infer():
     #    unet.train(False)  # fixate regularization for forward-only!  TODO Unet live segmentation
 
     for sample in ds_test:
+        sample = data.batch_to_dtype(sample)
         case_id = sample[data.KEY_CASE_ID].cpu().numpy()[0]
 
         nifph = nib.load('/share/data_zoe1/lucas/Linda_Segmentations/' + str(case_id) + '/train' + str(case_id) +
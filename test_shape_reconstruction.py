@@ -17,12 +17,16 @@ def test(args):
         transform = [data.ResamplePlaneXY(args.xyresample),
                      data.PadImages(pad[0], pad[1], pad[2], pad_value=pad_value),
                      data.ToTensor()]
-        ds_test = data.get_testdata(modalities=modalities, labels=labels, transform=transform, indices=args.fold[idx])
+        ds_test = data.get_testdata(modalities=modalities, labels=labels, transform=transform, indices=args.fold[idx],
+                                    cache_dir=args.cachedir, transform_cache=args.transformcache,
+                                    num_workers=args.workers, decode_threads=args.decodethreads,
+                                    read_ahead=args.readahead)
 
         print('Size test set:', len(ds_test.sampler.indices), '| # batches:', len(ds_test))
 
         # Single case evaluation
-        tester = CaeReconstructionTester(ds_test, args.path[idx], args.outbasepath, normalization_hours_penumbra)
+        tester = CaeReconstructionTester(ds_test, args.path[idx], args.outbasepath, normalization_hours_penumbra,
+                                         n_thresholds=args.thresholds)
         tester.run_inference()
 
 
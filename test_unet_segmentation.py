@@ -18,12 +18,17 @@ def test(args):
     transform = [data.ResamplePlaneXY(args.xyresample),
                  data.PadImages(pad[0], pad[1], pad[2], pad_value=pad_value),
                  data.ToTensor()]
-    ds_test = data.get_testdata(modalities=modalities, labels=labels, transform=transform, indices=args.fold)
+    if args.bboxcrop:
+        # Background equals the pad value, thus outputs within the box are the same as on the full volume
+        transform.insert(1, data.CropToBoundingBox(stride=4, background=pad_value))
+    ds_test = data.get_testdata(modalities=modalities, labels=labels, transform=transform, indices=args.fold,
+                                cache_dir=args.cachedir, transform_cache=args.transformcache,
+                                decode_threads=args.decodethreads)
 
     print('Size test set:', len(ds_test.sampler.indices), '| # batches:', len(ds_test))
 
     # Single case evaluation
-    tester = UnetSegmentationTester(ds_test, path_saved_model, args.outbasepath, None)
+    tester = UnetSegmentationTester(ds_test, path_saved_model, args.outbasepath, None, n_thresholds=args.thresholds)
     tester.run_inference()
 
 
@@ -12,7 +12,7 @@ class CaeReconstructionTesterCurve(CaeReconstructionTester):
 
     def infer_batch(self, batch: dict, step: float):
         dto = self.inference_step(batch, step)
-        batch_metrics = self.batch_metrics_step(dto)
+        batch_metrics = self.batch_metrics_step(dto, data.batch_spacing(batch), batch)
         return batch_metrics, dto
 
     def run_inference(self):
@@ -3,7 +3,9 @@ from common.inference.Inference import Inference
 from common.dto.MetricMeasuresDto import MetricMeasuresDto
 import common.dto.MetricMeasuresDto as MetricMeasuresDtoInit
 from torch.utils.data import DataLoader
+from common import data, metrics
 import torch
+import csv
 
 
 class Tester(Inference):
@@ -13,26 +15,90 @@ class Tester(Inference):
     procedures required for a specific test run.
     """
 
-    def __init__(self, dataloader: DataLoader, path_model: str, path_outputs_base: str='/tmp/'):
+    def __init__(self, dataloader: DataLoader, path_model: str, path_outputs_base: str='/tmp/', n_thresholds: int=0):
         Inference.__init__(self, torch.load(path_model))
         assert dataloader.batch_size == 1, "You must ensure a batch size of 1 for correct case metric measures."
         self._dataloader = dataloader
         self._path_outputs_base = path_outputs_base
+        self._n_thresholds = n_thresholds  # thresholds of the metric curves per case, 0 for none
         self._model.freeze(True)
         self._model.eval()
 
     def infer_batch(self, batch: dict):
         dto = self.inference_step(batch)
-        batch_metrics = self.batch_metrics_step(dto)
+        batch_metrics = self.batch_metrics_step(dto, data.batch_spacing(batch), batch)
         self.save_inference(dto, batch)
+        if self._n_thresholds > 0:
+            self.save_curves(batch_metrics, batch)
         return batch_metrics, dto
 
-    def batch_metrics_step(self, dto: Dto):
-        return MetricMeasuresDtoInit.init_dto()
+    def metric_labels(self, dto: Dto):
+        """(name, output, ground truth) of the labels measured by batch_metrics_step, name as in MetricMeasuresDto."""
+        return []
+
+    def batch_metrics_step(self, dto: Dto, voxelspacing=None, batch: dict=None):
+        """
+        Measures of the metric_labels and, with n_thresholds, their metric curves (curves attribute, per label).
+        :param voxelspacing: spacing per sample for the surface distances, see data.batch_spacing, else voxels
+        :param batch:        batch of the dto; outputs and labels of a cropped case are measured on the full size
+        """
+        batch_metrics = MetricMeasuresDtoInit.init_dto()
+        labels = self.metric_labels(dto)
+        if batch is not None:
+            labels = [(name, self._paste_tensor(result, batch), self._paste_tensor(target, batch))
+                      for name, result, target in labels]
+        if labels:
+            names, results, targets = zip(*labels)
+            for name, measures in zip(names, metrics.binary_measures_batch(results, targets,
+                                                                           voxelspacing=voxelspacing)):
+                setattr(batch_metrics, name, measures)
+            if self._n_thresholds > 0:
+                batch_metrics.curves = {name: metrics.threshold_curves(result, target, self._n_thresholds)
+                                        for name, result, target in labels}
+        return batch_metrics
+
+    def save_curves(self, batch_metrics: MetricMeasuresDto, batch: dict):
+        """Writes the metric curves of a case as csv, one row per label and threshold, next to its outputs."""
+        case_id = int(batch[data.KEY_CASE_ID])
+        filename = self._path_outputs_base + '_' + str(case_id) + '_curves.csv'
+        columns = ['threshold', 'tp', 'fp', 'fn', 'tn', 'dc', 'precision', 'sensitivity', 'specificity']
+        with open(filename, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['label'] + columns)
+            for name, curves in sorted(batch_metrics.curves.items()):
+                for row in zip(*[curves[column] for column in columns]):
+                    writer.writerow([name] + ['{:g}'.format(value) for value in row])
 
     def _fn(self, case_id, type, suffix):
         return self._path_outputs_base + '_' + str(case_id) + str(type) + str(suffix) + '.nii.gz'
 
+    def _bounding_box(self, batch: dict):
+        """Bounding box of a case cropped with data.CropToBoundingBox, otherwise None."""
+        if data.KEY_BBOX not in batch:
+            return None
+        return batch[data.KEY_BBOX][0].numpy()
+
+    def _paste(self, image, batch: dict):
+        """Pastes an XxYxZ output of a cropped case back into a volume of the full size."""
+        bbox = self._bounding_box(batch)
+        if bbox is None:
+            return image
+        return data.paste_bounding_box(image, bbox)
+
+    def _paste_tensor(self, tensor, batch: dict):
+        """Pastes a BxCxZxYxX output or label tensor of a cropped case back into a zero tensor of the full size."""
+        bbox = self._bounding_box(batch)
+        if bbox is None:
+            return tensor
+        bbox = bbox[::-1]  # XYZ to the ZYX axes of the tensor
+        result = tensor.new_zeros(tensor.size()[:2] + tuple(int(full) for _, _, full in bbox))
+        result[(slice(None), slice(None)) + tuple(slice(int(start), int(stop)) for start, stop, _ in bbox)] = tensor
+        return result
+
+    def _full_volume(self, output, batch: dict):
+        """XxYxZ numpy volume of the full size from a 1x1xZxYxX output variable."""
+        return self._paste(output.cpu().data.numpy()[0, 0, :, :, :].T, batch)
+
     def save_inference(self, dto: Dto, batch: dict):
         pass
 
@@ -0,0 +1,83 @@
+import unittest
+import numpy as np
+from torch.utils.data import DataLoader
+from torchvision import transforms
+from common import data
+
+
+class RecordingArray(object):
+    """Array proxy as nibabel's dataobj, recording the regions read."""
+    def __init__(self, array, reads):
+        self._array = array
+        self._reads = reads
+        self.shape = array.shape
+
+    def __getitem__(self, key):
+        self._reads.append(tuple((index.start, index.stop) for index in key))
+        return self._array[key]
+
+
+def make_sample(case_id, reads=None, size=(64, 64, 28)):
+    random_state = np.random.RandomState(case_id)
+    images = [random_state.rand(*size).astype(np.float32) for _ in range(2)]
+    labels = [(random_state.rand(*size) > 0.9).astype(np.uint8) for _ in range(2)]
+    sample = {data.KEY_CASE_ID: case_id, data.KEY_GLOBAL: np.zeros((1, 1, 1, 2))}
+    if reads is None:
+        sample[data.KEY_IMAGES] = data.stack_channels(images, np.float32)
+        sample[data.KEY_LABELS] = data.stack_channels(labels)
+    else:
+        sample[data.KEY_IMAGES] = data.ProxyVolume([RecordingArray(a, reads) for a in images], np.float32)
+        sample[data.KEY_LABELS] = data.ProxyVolume([RecordingArray(a, reads) for a in labels])
+    return sample
+
+
+def patch_transform(n_patches, foreground_ratio=0.0):
+    return transforms.Compose([data.ResamplePlaneXY(0.5),
+                               data.PadImages(4, 4, 2),
+                               data.PatchesPerCase(n_patches, transforms.Compose([
+                                   data.ForegroundPatch(24, 24, 12, 4, 4, 2, foreground_ratio=foreground_ratio),
+                                   data.ToTensor()]))])
+
+
+class PatchesPerCaseTest(unittest.TestCase):
+
+    def test_batches_of_many_patches_per_case(self):
+        for n_patches in [4, 6, 8]:
+            cases = data.cases_per_batch(6, n_patches)
+            self.assertGreater(cases, 1)  # required by Learner for normalization layers
+            transform = patch_transform(n_patches)
+            samples = [transform(make_sample(case_id)) for case_id in range(4)]
+            loader = DataLoader(samples, batch_size=cases, collate_fn=data.collate_samples)
+            batch = next(iter(loader))
+            self.assertEqual(batch[data.KEY_IMAGES].size(0), cases * n_patches)
+            self.assertEqual(tuple(batch[data.KEY_LABELS].size()[1:]), (2, 8, 16, 16))
+
+    def test_lazy_patches_read_only_their_region(self):
+        reads = []
+        patches = data.materialize_sample(patch_transform(4)(make_sample(1, reads)))
+        self.assertEqual(len(patches), 4)
+        self.assertEqual(len(reads), 4 * 4)  # 2 image and 2 label channels per patch
+        for box in reads:
+            self.assertTrue(all(stop - start < size for (start, stop), size in zip(box, (64, 64, 28))))
+
+    def test_foreground_patches_contain_foreground(self):
+        sample = make_sample(2)
+        labels = np.zeros_like(sample[data.KEY_LABELS])
+        labels[40, 20, 14, 1] = 1
+        sample[data.KEY_LABELS] = labels
+        flipped = data.HemisphericFlipFixedToCaseId(split_id=0)(sample)  # case 2 is flipped
+        transform = data.ForegroundPatch(24, 24, 12, 4, 4, 2, foreground_ratio=1.0, cache_index=False)
+        for current in [sample, flipped, sample]:
+            for _ in range(5):
+                self.assertEqual(transform(current)[data.KEY_LABELS][:, :, :, 1].sum(), 1)
+
+    def test_foreground_index_cache_requires_deterministic_transforms(self):
+        with self.assertRaises(AssertionError):
+            data.check_foreground_patches([data.HemisphericFlip(), patch_transform(4).transforms[-1]])
+        data.check_foreground_patches(patch_transform(4).transforms)
+        data.check_foreground_patches([data.HemisphericFlip(),
+                                       data.ForegroundPatch(24, 24, 12, 4, 4, 2, cache_index=False)])
+
+
+if __name__ == '__main__':
+    unittest.main()
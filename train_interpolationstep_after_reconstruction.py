@@ -53,7 +53,15 @@ def train(args):
               '_FUCT_MAP_T_Samplespace_subset_reg1_downsampled']
 
     ds_train, ds_valid = data.get_stroke_shape_training_data(modalities, labels, train_transform, valid_transform,
-                                                             args.fold, args.validsetsize, batchsize=args.batchsize)
+                                                             args.fold, args.validsetsize, batchsize=args.batchsize,
+                                                             cache_dir=args.cachedir,
+                                                             transform_cache=args.transformcache,
+                                                             num_workers=args.workers, pin_memory=args.pinmemory,
+                                                             prefetch_factor=args.prefetchfactor,
+                                                             persistent_workers=args.persistentworkers,
+                                                             resident=args.resident, decode_threads=args.decodethreads,
+                                                             read_ahead=args.readahead, image_dtype=args.imagedtype,
+                                                             pack_labels=args.packlabels, infinite=args.steps > 0)
     print('Size training set:', len(ds_train.sampler.indices),
           'samples | Size validation set:', len(ds_valid.sampler.indices),
           'samples | Capacity batch:', args.batchsize, 'samples')
@@ -65,8 +73,10 @@ def train(args):
                              n_epochs=args.epochs,
                              path_previous_base=args.inbasepath,
                              path_outputs_base=args.outbasepath,
-                             criterion=criterion)
-    learner.run_training()
+                             criterion=criterion,
+                             resident_validation=args.residentvalidation,
+                             metrics_service=util.get_metrics_service(args))
+    util.run_training(learner, args)
 
 
 if __name__ == '__main__':
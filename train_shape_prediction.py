@@ -1,7 +1,7 @@
 import torch
 import datetime
 from learner.CaePredictionLearner import CaePredictionLearner
-from common import data, util, metrics
+from common import data, util, metrics, augmentation
 from common.model.Cae3D import Enc3D
 
 
@@ -48,13 +48,27 @@ def train(args):
     # Data
     common_transform = [data.ResamplePlaneXY(args.xyresample),
                         data.HemisphericFlipFixedToCaseId(split_id=args.hemisflipid)]
-    train_transform = common_transform + [data.ElasticDeform(apply_to_images=True), data.ToTensor()]
+    if args.batchaugment:
+        train_transform = common_transform + [data.ToTensor()]
+        batch_transform = augmentation.BatchElasticDeform(apply_to_images=True)
+    else:
+        train_transform = common_transform + [data.ElasticDeform(apply_to_images=True, fast=args.fastelastic),
+                                              data.ToTensor()]
+        batch_transform = None
     valid_transform = common_transform + [data.ToTensor()]
     modalities = ['_unet_core', '_unet_penu']
     labels = ['_CBVmap_subset_reg1_downsampled', '_TTDmap_subset_reg1_downsampled',
               '_FUCT_MAP_T_Samplespace_subset_reg1_downsampled']
     ds_train, ds_valid = data.get_stroke_prediction_training_data(modalities, labels, train_transform, valid_transform,
-                                                                  args.fold, args.validsetsize, batchsize=args.batchsize)
+                                                                  args.fold, args.validsetsize, batchsize=args.batchsize,
+                                                                  cache_dir=args.cachedir,
+                                                                  transform_cache=args.transformcache,
+                                                                  num_workers=args.workers, pin_memory=args.pinmemory,
+                                                                  prefetch_factor=args.prefetchfactor,
+                                                                  persistent_workers=args.persistentworkers,
+                                                                  resident=args.resident, decode_threads=args.decodethreads,
+                                                                  read_ahead=args.readahead, image_dtype=args.imagedtype,
+                                                                  pack_labels=args.packlabels, infinite=args.steps > 0)
     print('Size training set:', len(ds_train.sampler.indices), 'samples | Size validation set:', len(ds_valid.sampler.indices),
           'samples | Capacity batch:', args.batchsize, 'samples')
     print('# training batches:', len(ds_train), '| # validation batches:', len(ds_valid))
@@ -64,8 +78,11 @@ def train(args):
                                    n_epochs=args.epochs,
                                    path_previous_base=args.inbasepath,
                                    path_outputs_base=args.outbasepath,
-                                   criterion=criterion)
-    learner.run_training()
+                                   criterion=criterion,
+                                   batch_transform=batch_transform,
+                                   resident_validation=args.residentvalidation,
+                                   metrics_service=util.get_metrics_service(args))
+    util.run_training(learner, args)
 
 
 if __name__ == '__main__':
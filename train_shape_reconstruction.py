@@ -1,8 +1,9 @@
 import torch
 import datetime
+from torchvision import transforms
 from learner.CaeReconstructionLearner import CaeReconstructionLearner
 from common.model.Cae3D import Cae3D, Enc3D, Enc3DStep, Dec3D
-from common import data, util, metrics
+from common import data, util, metrics, augmentation
 
 
 def train(args):
@@ -45,7 +46,14 @@ def train(args):
 
     # Data
     common_transform = [data.ResamplePlaneXY(args.xyresample)]  # before: FixedToCaseId(split_id=args.hemisflipid)]
-    train_transform = common_transform + [data.HemisphericFlip(), data.ElasticDeform(), data.ToTensor()]
+    if args.batchaugment:
+        train_transform = common_transform + [data.ToTensor()]
+        batch_transform = transforms.Compose([augmentation.BatchHemisphericFlip(),
+                                              augmentation.BatchElasticDeform()])
+    else:
+        train_transform = common_transform + [data.HemisphericFlip(), data.ElasticDeform(fast=args.fastelastic),
+                                             data.ToTensor()]
+        batch_transform = None
     valid_transform = common_transform + [data.ToTensor()]
 
     modalities = ['_CBV_reg1_downsampled', '_TTD_reg1_downsampled']  # dummy data only needed for visualization
@@ -53,7 +61,15 @@ def train(args):
               '_FUCT_MAP_T_Samplespace_subset_reg1_downsampled']
 
     ds_train, ds_valid = data.get_stroke_shape_training_data(modalities, labels, train_transform, valid_transform,
-                                                             args.fold, args.validsetsize, batchsize=args.batchsize, split=use_validation)
+                                                             args.fold, args.validsetsize, batchsize=args.batchsize, split=use_validation,
+                                                             cache_dir=args.cachedir,
+                                                             transform_cache=args.transformcache,
+                                                             num_workers=args.workers, pin_memory=args.pinmemory,
+                                                             prefetch_factor=args.prefetchfactor,
+                                                             persistent_workers=args.persistentworkers,
+                                                             resident=args.resident, decode_threads=args.decodethreads,
+                                                             read_ahead=args.readahead, image_dtype=args.imagedtype,
+                                                             pack_labels=args.packlabels, infinite=args.steps > 0)
     if use_validation:
         print('Size training set:', len(ds_train.sampler.indices), 'samples | Size validation set:', len(ds_valid.sampler.indices),
               'samples | Capacity batch:', args.batchsize, 'samples')
@@ -68,8 +84,11 @@ def train(args):
                                        n_epochs=args.epochs,
                                        path_previous_base=args.inbasepath,
                                        path_outputs_base=args.outbasepath,
-                                       criterion=criterion)
-    learner.run_training()
+                                       criterion=criterion,
+                                       batch_transform=batch_transform,
+                                       resident_validation=args.residentvalidation,
+                                       metrics_service=util.get_metrics_service(args))
+    util.run_training(learner, args)
 
 
 if __name__ == '__main__':
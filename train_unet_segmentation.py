@@ -1,5 +1,6 @@
 import torch
 import datetime
+from torchvision import transforms
 from learner.UnetSegmentationLearner import UnetSegmentationLearner
 from common.model.Unet3D import Unet3D
 from common import data, util, metrics
@@ -10,6 +11,7 @@ def train():
 
     # Params / Config
     batchsize = 6  # 17 training, 6 validation
+    cases_per_batch = data.cases_per_batch(batchsize, args.patchespercase)  # about batchsize training patches
     learning_rate = 1e-3
     momentums_cae = (0.99, 0.999)
     criterion = metrics.BatchDiceLoss([1.0])  # nn.BCELoss()
@@ -39,23 +41,35 @@ def train():
     train_transform = [data.ResamplePlaneXY(args.xyresample),
                        data.HemisphericFlipFixedToCaseId(split_id=args.hemisflipid),
                        data.PadImages(pad[0], pad[1], pad[2], pad_value=0),
-                       data.RandomPatch(104, 104, 68, pad[0], pad[1], pad[2]),
-                       data.ToTensor()]
+                       data.PatchesPerCase(args.patchespercase, transforms.Compose([
+                           data.ForegroundPatch(104, 104, 68, pad[0], pad[1], pad[2],
+                                                foreground_ratio=args.foregroundratio),
+                           data.ToTensor()]))]
     valid_transform = [data.ResamplePlaneXY(args.xyresample),
                        data.HemisphericFlipFixedToCaseId(split_id=args.hemisflipid),
                        data.PadImages(pad[0], pad[1], pad[2], pad_value=0),
                        data.RandomPatch(104, 104, 68, pad[0], pad[1], pad[2]),
                        data.ToTensor()]
-    ds_train, ds_valid = data.get_stroke_shape_training_data(train_transform, valid_transform, args.fold,
-                                                             args.validsetsize, batchsize=batchsize)
+    modalities = ['_CBV_reg1_downsampled', '_TTD_reg1_downsampled']
+    labels = ['_CBVmap_subset_reg1_downsampled', '_TTDmap_subset_reg1_downsampled']
+    ds_train, ds_valid = data.get_stroke_shape_training_data(modalities, labels, train_transform, valid_transform,
+                                                             args.fold, args.validsetsize, batchsize=cases_per_batch,
+                                                             cache_dir=args.cachedir, lazy=args.lazy,
+                                                             num_workers=args.workers, pin_memory=args.pinmemory,
+                                                             prefetch_factor=args.prefetchfactor,
+                                                             persistent_workers=args.persistentworkers,
+                                                             decode_threads=args.decodethreads, read_ahead=args.readahead,
+                                                             image_dtype=args.imagedtype, pack_labels=args.packlabels,
+                                                             infinite=args.steps > 0)
     print('Size training set:', len(ds_train.sampler.indices), 'samples | Size validation set:', len(ds_valid.sampler.indices),
-          'samples | Capacity batch:', batchsize, 'samples')
+          'samples | Capacity batch:', cases_per_batch, 'x', args.patchespercase, 'patches')
     print('# training batches:', len(ds_train), '| # validation batches:', len(ds_valid))
 
     # Training
-    learner = UnetSegmentationLearner(ds_train, ds_valid, unet, path_saved_model, optimizer, scheduler, criterion,
-                                      path_previous_base=args.inbasepath, path_outputs_base=args.outbasepath)
-    learner.run_training()
+    learner = UnetSegmentationLearner(ds_train, ds_valid, unet, optimizer, scheduler, args.epochs, criterion,
+                                      path_outputs_base=args.outbasepath, resident_validation=args.residentvalidation,
+                                      metrics_service=util.get_metrics_service(args))
+    util.run_training(learner, args)
 
 
 if __name__ == '__main__':